@@ -0,0 +1,341 @@
+"""
+Token budgeting and cost accounting for upstream OpenAI calls.
+
+Every upstream call goes through three steps:
+  1. a local pre-flight estimate of input tokens (tiktoken when installed,
+     a conservative character heuristic otherwise),
+  2. per-request and per-client budget checks that reserve the worst case
+     before anything is sent, so concurrent requests cannot all pass,
+  3. settling the reservation to the usage reported by the upstream
+     response (or releasing it when the call fails).
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # declared dependency, but fall back to a character-based estimate
+    tiktoken = None
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+# Per-request limits
+MAX_INPUT_TOKENS = _env_int("MAX_INPUT_TOKENS", 16000)
+MAX_OUTPUT_TOKENS = _env_int("MAX_OUTPUT_TOKENS", 4000)
+# o1 reasoning tokens count against max_output_tokens, so it needs far more room
+OPTIMIZER_MAX_OUTPUT_TOKENS = _env_int("OPTIMIZER_MAX_OUTPUT_TOKENS", 16000)
+MAX_REQUEST_COST_USD = _env_float("MAX_REQUEST_COST_USD", 1.50)
+
+# Inputs above this size skip o1 and go straight to the cheap model
+CHEAP_ROUTE_INPUT_TOKENS = _env_int("CHEAP_ROUTE_INPUT_TOKENS", 4000)
+
+# Per-client limits, reset every CLIENT_BUDGET_WINDOW_SECONDS (0 disables a limit)
+CLIENT_TOKEN_BUDGET = _env_int("CLIENT_TOKEN_BUDGET", 500000)
+CLIENT_COST_BUDGET_USD = _env_float("CLIENT_COST_BUDGET_USD", 5.0)
+CLIENT_BUDGET_WINDOW_SECONDS = _env_int("CLIENT_BUDGET_WINDOW_SECONDS", 86400)
+# X-Client-Id is caller-chosen, so it only keys budgets behind a gateway that sets it
+TRUST_CLIENT_ID_HEADER = os.getenv("TRUST_CLIENT_ID_HEADER", "false").lower() in ("1", "true", "yes")
+# Ledgers kept in memory; the least recently active client is dropped beyond this
+CLIENT_MAX_LEDGERS = _env_int("CLIENT_MAX_LEDGERS", 10000)
+
+OPTIMIZER_MODEL = "o1"
+FALLBACK_MODEL = "gpt-4o-mini"
+
+# USD per 1M tokens: (input, output)
+MODEL_PRICING = {
+    "o1": (15.00, 60.00),
+    "o1-mini": (3.00, 12.00),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+DEFAULT_PRICING = MODEL_PRICING["gpt-4o"]
+
+# Chat-format overhead per message (role markers, separators)
+TOKENS_PER_MESSAGE = 4
+
+
+class BudgetExceededError(Exception):
+    """Raised when a request would exceed a token or cost budget."""
+
+    def __init__(self, message: str, status_code: int = 429):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class Usage:
+    """Token usage and cost for one or more upstream calls."""
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cost_usd: float = 0.0
+    model: Optional[str] = None
+    estimated: bool = False
+    cached: bool = False
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    def __add__(self, other: "Usage") -> "Usage":
+        return Usage(
+            input_tokens=self.input_tokens + other.input_tokens,
+            output_tokens=self.output_tokens + other.output_tokens,
+            cost_usd=self.cost_usd + other.cost_usd,
+            model=other.model or self.model,
+            estimated=self.estimated or other.estimated,
+            cached=self.cached and other.cached,
+        )
+
+
+def _get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def estimate_tokens(text: str, model: str = OPTIMIZER_MODEL) -> int:
+    """Estimate the number of tokens in text without calling upstream."""
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # ~4 characters per token for ASCII text; non-ASCII text (CJK, emoji) can
+    # take a token per character or more, so count its UTF-8 bytes / 2 instead
+    ascii_chars = sum(1 for c in text if c.isascii())
+    non_ascii_bytes = len(text.encode("utf-8")) - ascii_chars
+    return math.ceil(ascii_chars / 4 + non_ascii_bytes / 2)
+
+
+def estimate_messages_tokens(messages: list, model: str = OPTIMIZER_MODEL) -> int:
+    """Estimate input tokens for a list of chat messages."""
+    return sum(
+        estimate_tokens(m.get("content", ""), model) + TOKENS_PER_MESSAGE
+        for m in messages
+    )
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    """Cost in USD for the given token counts on a model."""
+    input_price, output_price = MODEL_PRICING.get(model, DEFAULT_PRICING)
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def _as_int(value) -> Optional[int]:
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+
+def usage_from_response(resp, model: str, fallback_input: int = 0, fallback_output_text: str = "") -> Usage:
+    """
+    Build a Usage from an upstream response.
+
+    Handles both the Responses API (input_tokens/output_tokens) and Chat
+    Completions (prompt_tokens/completion_tokens). Falls back to local
+    estimates when the response carries no usage data.
+    """
+    raw = getattr(resp, "usage", None)
+    input_tokens = _as_int(getattr(raw, "input_tokens", None))
+    if input_tokens is None:
+        input_tokens = _as_int(getattr(raw, "prompt_tokens", None))
+    output_tokens = _as_int(getattr(raw, "output_tokens", None))
+    if output_tokens is None:
+        output_tokens = _as_int(getattr(raw, "completion_tokens", None))
+
+    estimated = input_tokens is None or output_tokens is None
+    if input_tokens is None:
+        input_tokens = fallback_input
+    if output_tokens is None:
+        output_tokens = estimate_tokens(fallback_output_text, model)
+
+    return Usage(
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        cost_usd=estimate_cost(model, input_tokens, output_tokens),
+        model=model,
+        estimated=estimated,
+    )
+
+
+def choose_optimizer_model(input_tokens: int) -> str:
+    """
+    Pick the model for prompt optimization.
+
+    Raises BudgetExceededError (413) for inputs above MAX_INPUT_TOKENS and
+    routes large inputs to the cheap model instead of a slow o1 call.
+    """
+    if input_tokens > MAX_INPUT_TOKENS:
+        raise BudgetExceededError(
+            f"Input is ~{input_tokens} tokens; the limit is {MAX_INPUT_TOKENS}",
+            status_code=413,
+        )
+    if input_tokens > CHEAP_ROUTE_INPUT_TOKENS:
+        return FALLBACK_MODEL
+    return OPTIMIZER_MODEL
+
+
+@dataclass
+class Reservation:
+    """Worst-case budget held for in-flight upstream calls until they are recorded or released."""
+    client_id: str
+    tokens: int
+    cost_usd: float
+    released: bool = False
+
+
+@dataclass
+class _ClientLedger:
+    window_start: float = field(default_factory=time.time)
+    window_usage: Usage = field(default_factory=Usage)
+    lifetime_usage: Usage = field(default_factory=Usage)
+    requests: int = 0
+    reserved_tokens: int = 0
+    reserved_cost_usd: float = 0.0
+
+
+class UsageTracker:
+    """
+    Thread-safe per-client usage aggregation and budget enforcement.
+
+    At most max_ledgers clients are tracked; beyond that the least recently
+    active client's ledger is dropped, which resets its window.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = CLIENT_TOKEN_BUDGET,
+        cost_budget_usd: float = CLIENT_COST_BUDGET_USD,
+        window_seconds: int = CLIENT_BUDGET_WINDOW_SECONDS,
+        max_request_cost_usd: float = MAX_REQUEST_COST_USD,
+        max_ledgers: int = CLIENT_MAX_LEDGERS,
+    ):
+        self.token_budget = token_budget
+        self.cost_budget_usd = cost_budget_usd
+        self.window_seconds = window_seconds
+        self.max_request_cost_usd = max_request_cost_usd
+        self.max_ledgers = max_ledgers
+        self._ledgers: "OrderedDict[str, _ClientLedger]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _ledger(self, client_id: str) -> _ClientLedger:
+        ledger = self._ledgers.get(client_id)
+        if ledger is None:
+            ledger = self._ledgers[client_id] = _ClientLedger()
+            while self.max_ledgers and len(self._ledgers) > self.max_ledgers:
+                self._ledgers.popitem(last=False)
+        else:
+            self._ledgers.move_to_end(client_id)
+        if self.window_seconds and time.time() - ledger.window_start >= self.window_seconds:
+            ledger.window_start = time.time()
+            ledger.window_usage = Usage()
+        return ledger
+
+    def check(self, client_id: str, model: str, input_tokens: int, max_output_tokens: int) -> Reservation:
+        """Reserve the worst case of this call, or raise BudgetExceededError if it would exceed a budget."""
+        return self.check_calls(client_id, [(model, input_tokens, max_output_tokens)])
+
+    def check_calls(self, client_id: str, calls: List[Tuple[str, int, int]]) -> Reservation:
+        """
+        Check and reserve the combined worst case of several upstream calls made for one request.
+
+        The reservation counts against the client's budget until it is
+        passed to record() or release(), so concurrent requests from one
+        client cannot all pass the check before any of them is recorded.
+
+        Args:
+            client_id: Identifier the usage is budgeted against
+            calls: (model, input_tokens, max_output_tokens) for each call
+
+        Returns:
+            The Reservation to settle with record() or release()
+        """
+        worst_tokens = sum(input_tokens + max_output for _, input_tokens, max_output in calls)
+        worst_cost = sum(estimate_cost(model, input_tokens, max_output) for model, input_tokens, max_output in calls)
+        if self.max_request_cost_usd and worst_cost > self.max_request_cost_usd:
+            raise BudgetExceededError(
+                f"Request may cost up to ${worst_cost:.4f}; the per-request limit is ${self.max_request_cost_usd:.2f}",
+                status_code=413,
+            )
+
+        with self._lock:
+            ledger = self._ledger(client_id)
+            used = ledger.window_usage
+            if self.token_budget and used.total_tokens + ledger.reserved_tokens + worst_tokens > self.token_budget:
+                raise BudgetExceededError(
+                    f"Client token budget of {self.token_budget} exhausted for this window"
+                )
+            if self.cost_budget_usd and used.cost_usd + ledger.reserved_cost_usd + worst_cost > self.cost_budget_usd:
+                raise BudgetExceededError(
+                    f"Client cost budget of ${self.cost_budget_usd:.2f} exhausted for this window"
+                )
+            ledger.reserved_tokens += worst_tokens
+            ledger.reserved_cost_usd += worst_cost
+            return Reservation(client_id, worst_tokens, worst_cost)
+
+    def _release_locked(self, reservation: Reservation) -> None:
+        if reservation.released:
+            return
+        reservation.released = True
+        ledger = self._ledgers.get(reservation.client_id)
+        if ledger is not None:
+            ledger.reserved_tokens = max(0, ledger.reserved_tokens - reservation.tokens)
+            ledger.reserved_cost_usd = max(0.0, ledger.reserved_cost_usd - reservation.cost_usd)
+
+    def release(self, reservation: Optional[Reservation]) -> None:
+        """Give back a reservation whose calls failed or were not made. Safe to call twice."""
+        if reservation is None:
+            return
+        with self._lock:
+            self._release_locked(reservation)
+
+    def record(self, client_id: str, usage: Usage, reservation: Optional[Reservation] = None) -> None:
+        """Add usage from a completed request to the client's totals, settling its reservation."""
+        with self._lock:
+            if reservation is not None:
+                self._release_locked(reservation)
+            ledger = self._ledger(client_id)
+            ledger.window_usage = ledger.window_usage + usage
+            ledger.lifetime_usage = ledger.lifetime_usage + usage
+            ledger.requests += 1
+
+    def summary(self) -> Dict[str, dict]:
+        """Aggregated usage per client."""
+        with self._lock:
+            return {
+                client_id: {
+                    "requests": ledger.requests,
+                    "window_tokens": ledger.window_usage.total_tokens,
+                    "window_cost_usd": round(ledger.window_usage.cost_usd, 6),
+                    "total_input_tokens": ledger.lifetime_usage.input_tokens,
+                    "total_output_tokens": ledger.lifetime_usage.output_tokens,
+                    "total_cost_usd": round(ledger.lifetime_usage.cost_usd, 6),
+                }
+                for client_id, ledger in self._ledgers.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._ledgers.clear()
+
+
+usage_tracker = UsageTracker()
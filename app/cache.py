@@ -0,0 +1,400 @@
+"""
+Semantic near-duplicate cache for optimized prompts.
+
+Prompts are normalized and their variable parts (names, numbers, emails,
+URLs) are replaced by slots, so "summarize this email from Bob" and
+"Summarize this email from Alice!" share a template. Templates are
+compared with MinHash signatures over character shingles (ignoring
+filler words such as "please" and "the"), indexed with
+LSH per OptimizationMode. When SEMANTIC_CACHE_EMBEDDING_MODEL is set and
+sentence-transformers is installed, cosine similarity of local embeddings
+is used instead.
+
+Similarity alone cannot tell "remote work is good" from "remote work is
+not good", so a near-duplicate is only served when the two templates
+differ in slots and filler words ("please", "the"); any other changed
+word is a miss however similar the prompts are. On a hit the cached
+optimization is returned with the old slot values replaced by the new
+ones.
+"""
+import hashlib
+import math
+import os
+import random
+import re
+import heapq
+import threading
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # optional: MinHash similarity is used instead
+    SentenceTransformer = None
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+SEMANTIC_CACHE_EMBEDDING_MODEL = os.getenv("SEMANTIC_CACHE_EMBEDDING_MODEL", "")
+
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 32
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+SHINGLE_SIZE = 5
+# Long prompts are signed from a consistent sample of their shingles (the
+# ones with the smallest hashes), keeping MinHash cost bounded
+MAX_SHINGLES = 512
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(0x5EED)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+SLOT = "\x00"
+
+# Order matters: emails before URLs before bare numbers
+_SLOT_PATTERNS = [
+    r"[\w.+-]+@[\w-]+\.[\w.-]+",
+    r"https?://\S+",
+    r"\d+(?:[.,:/-]\d+)*",
+]
+# Words whose presence does not change what a prompt asks for. Negations,
+# conjunctions and comparatives ("not", "or", "more") are deliberately absent.
+_FILLER_WORDS = frozenset(
+    "a an the this that these those please kindly can could would will you me i my your "
+    "it its is are be just hi hey".split()
+)
+
+# Capitalized words that are not sentence-initial are treated as names
+_NAME_PATTERN = r"(?<=[^.!?:\s]\s)[A-Z][a-z][a-zA-Z'-]*"
+_NON_NAMES = {"I", "I'm", "I've", "I'd", "I'll"}
+_SLOT_RE = re.compile("|".join(f"({p})" for p in _SLOT_PATTERNS + [_NAME_PATTERN]))
+
+
+def normalize(text: str) -> str:
+    """Lowercase, strip punctuation and collapse whitespace."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"[^\w\s\x00]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def extract_slots(text: str) -> Tuple[str, List[str]]:
+    """
+    Split a prompt into a normalized template and its slot values.
+
+    Returns:
+        The normalized template with slots marked, and the original slot
+        values in order of appearance
+    """
+    values = []
+
+    def _replace(match):
+        value = match.group(0)
+        if value in _NON_NAMES:
+            return value
+        values.append(value.rstrip(".,;:!?"))
+        return f" {SLOT} "
+
+    template = _SLOT_RE.sub(_replace, text.strip())
+    return normalize(template), values
+
+
+def _boundary(char: str, ahead: bool = False) -> str:
+    # Numbers may touch letters ("3pm"), words may not touch other word characters
+    cls = r"\d" if char.isdigit() else r"\w"
+    return rf"(?!{cls})" if ahead else rf"(?<!{cls})"
+
+
+def substitute_slots(text: str, old_values: List[str], new_values: List[str]) -> Optional[str]:
+    """
+    Replace old slot values in text with the new ones.
+
+    Returns None when the text cannot be safely re-used: the mapping is
+    ambiguous (one old value mapping to different new values), or a value
+    that changed does not appear in text (e.g. the optimizer spelled "3"
+    out as "three"), so the old detail would leak into the result.
+    """
+    if len(old_values) != len(new_values):
+        return None
+    mapping: Dict[str, str] = {}
+    for old, new in zip(old_values, new_values):
+        key = old.lower()
+        if key in mapping and mapping[key].lower() != new.lower():
+            return None
+        mapping[key] = new
+    mapping = {old: new for old, new in mapping.items() if old != new.lower()}
+    if not mapping:
+        return text
+    patterns = {
+        old: _boundary(old[0]) + re.escape(old) + _boundary(old[-1], ahead=True)
+        for old in sorted(mapping, key=len, reverse=True)
+    }
+    if not all(re.search(p, text, re.IGNORECASE) for p in patterns.values()):
+        return None
+    # Single pass so swapped values ("Bob to Alice" -> "Alice to Bob") do not chain
+    pattern = re.compile("|".join(patterns.values()), re.IGNORECASE)
+    return pattern.sub(lambda m: mapping[m.group(0).lower()], text)
+
+
+def align_slots(
+    entry_template: str, entry_values: List[str], template: str, values: List[str], text: str
+) -> Optional[Tuple[List[str], List[str]]]:
+    """
+    Pair up slot values of two templates that differ only in name casing.
+
+    Lowercase names ("in python") are not lifted into slots, so "Fix this
+    code in Python" and "fix this code in python" get different templates.
+    Word-by-word alignment lets a plain word match a slot holding the same
+    value. A different lowercase name ("from alice" vs "from Bob") is not
+    matched, since it cannot be told apart from an ordinary word.
+
+    Returns:
+        (old values, new values) to substitute, or None when the templates
+        differ in anything other than slot positions
+    """
+    entry_tokens, tokens = entry_template.split(" "), template.split(" ")
+    if len(entry_tokens) != len(tokens):
+        return None
+    entry_slots, slots = iter(entry_values), iter(values)
+    old_values, new_values = [], []
+    for entry_token, token in zip(entry_tokens, tokens):
+        if entry_token == token != SLOT:
+            continue
+        if SLOT not in (entry_token, token):
+            return None
+        old = next(entry_slots) if entry_token == SLOT else entry_token
+        new = next(slots) if token == SLOT else _original_casing(token, text)
+        # A plain word only matches a slot holding the same value in different
+        # casing; a different lowercase word may just be an ordinary word
+        if entry_token != token and old.lower() != new.lower():
+            return None
+        old_values.append(old)
+        new_values.append(new)
+    return old_values, new_values
+
+
+def _without_filler(template: str) -> str:
+    return " ".join(word for word in template.split(" ") if word not in _FILLER_WORDS)
+
+
+def only_incidental_changes(entry_template: str, template: str) -> bool:
+    """Whether two templates differ only in slots and filler words, ignoring word order."""
+    entry_words, words = Counter(entry_template.split(" ")), Counter(template.split(" "))
+    changed = (entry_words - words) + (words - entry_words)
+    return all(word == SLOT or word in _FILLER_WORDS for word in changed)
+
+
+def _original_casing(word: str, text: str) -> str:
+    match = re.search(rf"(?<!\w){re.escape(word)}(?!\w)", text, re.IGNORECASE)
+    return match.group(0) if match else word
+
+
+def _shingles(template: str) -> set:
+    if len(template) <= SHINGLE_SIZE:
+        return {template}
+    return {template[i:i + SHINGLE_SIZE] for i in range(len(template) - SHINGLE_SIZE + 1)}
+
+
+def _hash_shingle(shingle: str) -> int:
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def minhash_signature(template: str) -> Tuple[int, ...]:
+    """MinHash signature of a template's character shingles (at most MAX_SHINGLES of them)."""
+    hashes = heapq.nsmallest(MAX_SHINGLES, {_hash_shingle(s) for s in _shingles(template)})
+    return tuple(
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+        for a, b in _PERMUTATIONS
+    )
+
+
+def signature_similarity(sig_a: Tuple[int, ...], sig_b: Tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of two MinHash signatures."""
+    return sum(a == b for a, b in zip(sig_a, sig_b)) / len(sig_a)
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+@dataclass
+class CacheEntry:
+    key: int
+    template: str
+    slot_values: List[str]
+    optimized: str
+    model: Optional[str]
+    signature: Tuple[int, ...]
+    embedding: Optional[List[float]] = None
+    exact_only: bool = False
+
+
+@dataclass
+class CacheHit:
+    optimized: str
+    similarity: float
+    model: Optional[str]
+
+
+@dataclass
+class _ModeIndex:
+    entries: "OrderedDict[int, CacheEntry]" = field(default_factory=OrderedDict)
+    buckets: Dict[Tuple[int, Tuple[int, ...]], set] = field(default_factory=lambda: defaultdict(set))
+    exact: Dict[str, int] = field(default_factory=dict)
+
+
+class SemanticCache:
+    """Thread-safe near-duplicate cache with one index per optimization mode."""
+
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+        embedding_model: str = SEMANTIC_CACHE_EMBEDDING_MODEL,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._embedder = None
+        if embedding_model and SentenceTransformer is not None:
+            self._embedder = SentenceTransformer(embedding_model)
+        elif embedding_model:
+            print("sentence-transformers is not installed, semantic cache is using MinHash similarity")
+        self._indexes: Dict[str, _ModeIndex] = defaultdict(_ModeIndex)
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, template: str) -> Optional[List[float]]:
+        if self._embedder is None:
+            return None
+        return [float(x) for x in self._embedder.encode(template.replace(SLOT, "_"))]
+
+    @staticmethod
+    def _band_keys(signature: Tuple[int, ...]):
+        for band in range(LSH_BANDS):
+            yield band, signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+
+    def _candidates(self, index: _ModeIndex, signature: Tuple[int, ...]) -> set:
+        keys = set()
+        for band_key in self._band_keys(signature):
+            keys |= index.buckets.get(band_key, set())
+        return keys
+
+    def lookup(self, text: str, mode: str, count: bool = True) -> Optional[CacheHit]:
+        """
+        Return a re-usable optimization for a near-duplicate prompt, if any.
+
+        Lookups with count=False (speculative ones) are left out of the hit
+        and miss counters.
+        """
+        template, values = extract_slots(text)
+        if not template:
+            return None
+        signature = minhash_signature(_without_filler(template))
+        embedding = self._embed(template)
+
+        with self._lock:
+            index = self._indexes[mode]
+            exact_key = index.exact.get(template)
+            if exact_key is not None:
+                scored = [(1.0, index.entries[exact_key], index.entries[exact_key].slot_values, values)]
+            else:
+                if embedding is not None:
+                    # Brute-force cosine search over the mode's embedding vectors
+                    candidates = [
+                        (_cosine(embedding, e.embedding), e) for e in index.entries.values() if not e.exact_only
+                    ]
+                else:
+                    candidates = [
+                        (signature_similarity(signature, index.entries[k].signature), index.entries[k])
+                        for k in self._candidates(index, signature)
+                    ]
+                scored = []
+                for similarity, entry in candidates:
+                    aligned = align_slots(entry.template, entry.slot_values, template, values, text)
+                    if aligned is not None:
+                        # Same template once lowercase names are treated as slots
+                        scored.append((1.0, entry, *aligned))
+                    elif only_incidental_changes(entry.template, template):
+                        scored.append((similarity, entry, entry.slot_values, values))
+
+            for similarity, entry, old_values, new_values in sorted(scored, key=lambda s: s[0], reverse=True):
+                if similarity < self.threshold:
+                    break
+                optimized = substitute_slots(entry.optimized, old_values, new_values)
+                if optimized is None:
+                    continue
+                index.entries.move_to_end(entry.key)
+                self.hits += count
+                return CacheHit(optimized=optimized, similarity=similarity, model=entry.model)
+
+            self.misses += count
+            return None
+
+    def store(
+        self, text: str, mode: str, optimized: str, model: Optional[str] = None, exact_only: bool = False
+    ) -> None:
+        """
+        Cache an optimization result for a prompt.
+
+        exact_only entries are kept out of the similarity index and only
+        serve lookups with the same template, e.g. speculative drafts whose
+        final text may extend them with a different intent.
+        """
+        template, values = extract_slots(text)
+        if not template or not optimized:
+            return
+        signature = minhash_signature(_without_filler(template))
+        embedding = self._embed(template)
+
+        with self._lock:
+            index = self._indexes[mode]
+            if template in index.exact:
+                self._remove(index, index.exact[template])
+            key = self._next_key
+            self._next_key += 1
+            index.entries[key] = CacheEntry(key, template, values, optimized, model, signature, embedding, exact_only)
+            index.exact[template] = key
+            if not exact_only:
+                for band_key in self._band_keys(signature):
+                    index.buckets[band_key].add(key)
+            while len(index.entries) > self.max_entries:
+                self._remove(index, next(iter(index.entries)))
+
+    def _remove(self, index: _ModeIndex, key: int) -> None:
+        entry = index.entries.pop(key)
+        index.exact.pop(entry.template, None)
+        for band_key in self._band_keys(entry.signature):
+            bucket = index.buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del index.buckets[band_key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": sum(len(i.entries) for i in self._indexes.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "threshold": self.threshold,
+                "similarity": "embedding" if self._embedder is not None else "minhash",
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+semantic_cache = SemanticCache()
@@ -12,8 +12,9 @@ def get_openai() -> OpenAI:
     if _client is None:
         # Only set project if it's a valid value (not the placeholder)
         project_id = os.getenv("OPENAI_PROJECT")
+        # Retries are owned by app.retry.call_with_retry, so disable the SDK's own
         if project_id and project_id != "your-openai-project-id-here":
-            _client = OpenAI(project=project_id)
+            _client = OpenAI(project=project_id, max_retries=0)
         else:
-            _client = OpenAI()
+            _client = OpenAI(max_retries=0)
     return _client
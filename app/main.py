@@ -1,11 +1,22 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Depends
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from .models import (
     ChatRequest, ChatResponse, OptimizeRequest, OptimizeResponse, 
-    AvailableModesResponse, ModeInfo
+    AvailableModesResponse, ModeInfo, TokenUsage, UsageSummaryResponse, CacheStatsResponse,
+    PrefetchRequest, PrefetchResponse, PrefetchStatsResponse
 )
-from .optimizer import rewrite_prompt, get_available_modes, get_mode_description, OptimizationMode
+from .optimizer import (
+    rewrite_prompt_with_usage, plan_rewrite, get_available_modes, get_mode_description,
+    OptimizationMode, DEFAULT_CLIENT_ID
+)
+from .budget import (
+    BudgetExceededError, Usage, usage_tracker, estimate_messages_tokens,
+    usage_from_response, MAX_OUTPUT_TOKENS, TOKENS_PER_MESSAGE, TRUST_CLIENT_ID_HEADER
+)
+from .cache import semantic_cache, SEMANTIC_CACHE_ENABLED
+from .retry import call_with_retry, stream_with_retry, skip_fallback, UpstreamBusyError
+from .prefetch import prefetch_scheduler, PREFETCH_ENABLED
 from .clients import get_openai
 
 app = FastAPI(title="Advanced Prompt Optimizer Proxy", version="1.0.0")
@@ -18,9 +29,56 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(BudgetExceededError)
+def budget_exceeded_handler(request: Request, exc: BudgetExceededError):
+    return JSONResponse(status_code=exc.status_code, content={"detail": str(exc)})
+
+@app.exception_handler(UpstreamBusyError)
+def upstream_busy_handler(request: Request, exc: UpstreamBusyError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(int(exc.retry_after))},
+    )
+
+def get_client_id(request: Request) -> str:
+    """
+    Identify the caller for budgeting by remote host.
+
+    The X-Client-Id header is only used when TRUST_CLIENT_ID_HEADER is set,
+    since otherwise rotating it would bypass per-client budgets.
+    """
+    client_id = request.headers.get("x-client-id")
+    if client_id and TRUST_CLIENT_ID_HEADER:
+        return client_id
+    return request.client.host if request.client else DEFAULT_CLIENT_ID
+
+def parse_mode(mode: str) -> OptimizationMode:
+    """Convert a mode string to the enum, falling back to standard for unknown modes."""
+    try:
+        return OptimizationMode(mode) if mode else OptimizationMode.STANDARD
+    except ValueError:
+        return OptimizationMode.STANDARD
+
+def interactive_request():
+    """Hold back prefetch jobs while a user-facing request is being served."""
+    with prefetch_scheduler.interactive():
+        yield
+
+def to_token_usage(usage: Usage) -> TokenUsage:
+    return TokenUsage(
+        input_tokens=usage.input_tokens,
+        output_tokens=usage.output_tokens,
+        total_tokens=usage.total_tokens,
+        cost_usd=round(usage.cost_usd, 6),
+        model=usage.model,
+        estimated=usage.estimated,
+        cached=usage.cached,
+    )
+
 @app.get("/healthz")
 def healthz():
-    return {"status": "ok", "version": "1.0.0", "features": ["multi-mode-optimization", "advanced-prompt-engineering"]}
+    return {"status": "ok", "version": "1.0.0", "features": ["multi-mode-optimization", "advanced-prompt-engineering", "token-budgeting", "semantic-cache", "upstream-retry", "prefetch"]}
 
 @app.get("/modes", response_model=AvailableModesResponse)
 def get_modes():
@@ -48,96 +106,165 @@ def get_modes():
     
     return AvailableModesResponse(modes=modes)
 
-@app.post("/optimize", response_model=OptimizeResponse)
-def optimize(req: OptimizeRequest):
+@app.get("/usage", response_model=UsageSummaryResponse)
+def get_usage():
+    """Get aggregated upstream token usage and cost per client."""
+    return UsageSummaryResponse(clients=usage_tracker.summary())
+
+@app.get("/cache/stats", response_model=CacheStatsResponse)
+def get_cache_stats():
+    """Get semantic cache size and hit rate."""
+    return CacheStatsResponse(**semantic_cache.stats())
+
+@app.post("/prefetch", response_model=PrefetchResponse)
+def prefetch(req: PrefetchRequest, request: Request):
+    """Queue a draft for low-priority speculative optimization into the cache."""
+    if not PREFETCH_ENABLED:
+        return PrefetchResponse(accepted=False, reason="Prefetch is disabled on this server")
+    if not SEMANTIC_CACHE_ENABLED:
+        return PrefetchResponse(accepted=False, reason="Semantic cache is disabled, prefetched results could not be reused")
+    job = prefetch_scheduler.submit(req.session_id, req.text, parse_mode(req.mode), get_client_id(request))
+    if job is None:
+        return PrefetchResponse(accepted=False, reason="Draft is too short to prefetch")
+    return PrefetchResponse(accepted=True)
+
+@app.get("/prefetch/stats", response_model=PrefetchStatsResponse)
+def get_prefetch_stats():
+    """Get prefetch job counts and prefetch spend."""
+    return PrefetchStatsResponse(**prefetch_scheduler.summary())
+
+@app.post("/optimize", response_model=OptimizeResponse, dependencies=[Depends(interactive_request)])
+def optimize(req: OptimizeRequest, request: Request):
     """Optimize a prompt using the specified mode."""
-    try:
-        # Convert string mode to enum
-        mode = OptimizationMode(req.mode) if req.mode else OptimizationMode.STANDARD
-        improved = rewrite_prompt(req.text, mode)
-        
-        return OptimizeResponse(
-            improved_prompt=improved,
-            mode_used=mode.value,
-            original_length=len(req.text),
-            optimized_length=len(improved)
-        )
-    except ValueError:
-        # Invalid mode, fall back to standard
-        improved = rewrite_prompt(req.text, OptimizationMode.STANDARD)
-        return OptimizeResponse(
-            improved_prompt=improved,
-            mode_used="standard",
-            original_length=len(req.text),
-            optimized_length=len(improved)
-        )
-
-@app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
+    client_id = get_client_id(request)
+    mode = parse_mode(req.mode)
+
+    # Reuse a prefetch of this exact draft that is still in flight
+    prefetch_scheduler.wait_for(req.text, mode)
+    improved, usage = rewrite_prompt_with_usage(req.text, mode, client_id)
+    return OptimizeResponse(
+        improved_prompt=improved,
+        mode_used=mode.value,
+        original_length=len(req.text),
+        optimized_length=len(improved),
+        usage=to_token_usage(usage)
+    )
+
+@app.post("/chat", response_model=ChatResponse, dependencies=[Depends(interactive_request)])
+def chat(req: ChatRequest, request: Request):
     """Process a chat request with prompt optimization."""
     client = get_openai()
+    client_id = get_client_id(request)
+
+    mode = parse_mode(req.optimization_mode)
+
+    # 1) Reserve the worst case of both upstream calls before spending on either;
+    #    the improved prompt can be at most the optimizer's output cap
+    _, optimizer_model, optimizer_input, optimizer_output = plan_rewrite(req.user_input, mode)
+    reservation = usage_tracker.check_calls(client_id, [
+        (optimizer_model, optimizer_input, optimizer_output),
+        (req.target_model, optimizer_output + TOKENS_PER_MESSAGE, MAX_OUTPUT_TOKENS),
+    ])
 
-    # 1) Improve the prompt using the specified mode
+    # 2) Improve the prompt using the specified mode, charged to that reservation
     try:
-        mode = OptimizationMode(req.optimization_mode) if req.optimization_mode else OptimizationMode.STANDARD
-        improved = rewrite_prompt(req.user_input, mode)
-    except ValueError:
-        mode = OptimizationMode.STANDARD
-        improved = rewrite_prompt(req.user_input, mode)
+        prefetch_scheduler.wait_for(req.user_input, mode)
+        improved, optimize_usage = rewrite_prompt_with_usage(req.user_input, mode, client_id, reservation=reservation)
+    finally:
+        usage_tracker.release(reservation)
+
+    # 3) Reserve the target call with its actual input
+    input_tokens = estimate_messages_tokens([{"role": "user", "content": improved}], req.target_model)
+    reservation = usage_tracker.check(client_id, req.target_model, input_tokens, MAX_OUTPUT_TOKENS)
 
-    # 2) Call the target model
+    # 4) Call the target model
     try:
-        if req.stream:
-            def gen():
-                with client.responses.stream(
-                    model=req.target_model,
-                    reasoning={"effort": req.reasoning_effort},
-                    input=[{"role": "user", "content": improved}],
-                ) as stream:
-                    for event in stream:
-                        if event.type == "response.output_text.delta":
-                            yield event.delta
-            return StreamingResponse(gen(), media_type="text/plain")
-
-        resp = client.responses.create(
-            model=req.target_model,
-            reasoning={"effort": req.reasoning_effort},
-            input=[{"role": "user", "content": improved}],
-        )
-        final = resp.output_text or ""
-        return JSONResponse(ChatResponse(
-            improved_prompt=improved, 
-            final_answer=final,
-            optimization_mode=mode.value
-        ).model_dump())
+        try:
+            if req.stream:
+                def gen():
+                    try:
+                        # Holds an upstream slot until the stream is fully read
+                        with stream_with_retry(
+                            client.responses.create,
+                            model=req.target_model,
+                            reasoning={"effort": req.reasoning_effort},
+                            input=[{"role": "user", "content": improved}],
+                            max_output_tokens=MAX_OUTPUT_TOKENS,
+                            stream=True,
+                        ) as stream:
+                            final = None
+                            for event in stream:
+                                if event.type == "response.output_text.delta":
+                                    yield event.delta
+                                elif event.type == "response.completed":
+                                    final = event.response
+                        usage_tracker.record(client_id, usage_from_response(final, req.target_model, input_tokens), reservation)
+                    finally:
+                        usage_tracker.release(reservation)
+                return StreamingResponse(gen(), media_type="text/plain")
+
+            resp = call_with_retry(
+                client.responses.create,
+                model=req.target_model,
+                reasoning={"effort": req.reasoning_effort},
+                input=[{"role": "user", "content": improved}],
+                max_output_tokens=MAX_OUTPUT_TOKENS,
+            )
+            final = resp.output_text or ""
+            answer_usage = usage_from_response(resp, req.target_model, input_tokens, final)
+            usage_tracker.record(client_id, answer_usage, reservation)
+            return JSONResponse(ChatResponse(
+                improved_prompt=improved, 
+                final_answer=final,
+                optimization_mode=mode.value,
+                usage=to_token_usage(optimize_usage + answer_usage)
+            ).model_dump())
         
-    except Exception as e:
-        # Fallback to regular chat completions if Responses API fails
-        print(f"Responses API failed for model {req.target_model}, falling back to chat completions: {e}")
+        except Exception as e:
+            if skip_fallback(e):
+                raise
+            # Fallback to regular chat completions if Responses API fails
+            print(f"Responses API failed for model {req.target_model}, falling back to chat completions: {e}")
         
-        if req.stream:
-            def gen():
-                resp = client.chat.completions.create(
-                    model=req.target_model,
-                    messages=[{"role": "user", "content": improved}],
-                    max_tokens=1000,
-                    temperature=0.1,
-                    stream=True
-                )
-                for chunk in resp:
-                    if chunk.choices[0].delta.content:
-                        yield chunk.choices[0].delta.content
-            return StreamingResponse(gen(), media_type="text/plain")
+            if req.stream:
+                def gen():
+                    try:
+                        streamed = []
+                        with stream_with_retry(
+                            client.chat.completions.create,
+                            model=req.target_model,
+                            messages=[{"role": "user", "content": improved}],
+                            max_tokens=1000,
+                            temperature=0.1,
+                            stream=True
+                        ) as resp:
+                            for chunk in resp:
+                                if chunk.choices[0].delta.content:
+                                    streamed.append(chunk.choices[0].delta.content)
+                                    yield chunk.choices[0].delta.content
+                        # Streamed chunks carry no usage, so record a local estimate
+                        usage = usage_from_response(None, req.target_model, input_tokens, "".join(streamed))
+                        usage_tracker.record(client_id, usage, reservation)
+                    finally:
+                        usage_tracker.release(reservation)
+                return StreamingResponse(gen(), media_type="text/plain")
         
-        resp = client.chat.completions.create(
-            model=req.target_model,
-            messages=[{"role": "user", "content": improved}],
-            max_tokens=1000,
-            temperature=0.1,
-        )
-        final = resp.choices[0].message.content or ""
-        return JSONResponse(ChatResponse(
-            improved_prompt=improved, 
-            final_answer=final,
-            optimization_mode=mode.value
-        ).model_dump())
+            resp = call_with_retry(
+                client.chat.completions.create,
+                model=req.target_model,
+                messages=[{"role": "user", "content": improved}],
+                max_tokens=1000,
+                temperature=0.1,
+            )
+            final = resp.choices[0].message.content or ""
+            answer_usage = usage_from_response(resp, req.target_model, input_tokens, final)
+            usage_tracker.record(client_id, answer_usage, reservation)
+            return JSONResponse(ChatResponse(
+                improved_prompt=improved, 
+                final_answer=final,
+                optimization_mode=mode.value,
+                usage=to_token_usage(optimize_usage + answer_usage)
+            ).model_dump())
+    except BaseException:
+        usage_tracker.release(reservation)
+        raise
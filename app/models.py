@@ -1,15 +1,25 @@
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 class OptimizeRequest(BaseModel):
     text: str = Field(..., description="The text to optimize")
     mode: Optional[str] = Field("standard", description="Optimization mode to apply")
 
+class TokenUsage(BaseModel):
+    input_tokens: int = Field(0, description="Input tokens consumed upstream")
+    output_tokens: int = Field(0, description="Output tokens (including reasoning) produced upstream")
+    total_tokens: int = Field(0, description="Total tokens consumed upstream")
+    cost_usd: float = Field(0.0, description="Cost of the upstream calls in USD")
+    model: Optional[str] = Field(None, description="Model that served the request")
+    estimated: bool = Field(False, description="Whether the counts are local estimates rather than upstream-reported")
+    cached: bool = Field(False, description="Whether the optimization was served from the semantic cache")
+
 class OptimizeResponse(BaseModel):
     improved_prompt: str = Field(..., description="The optimized prompt")
     mode_used: str = Field(..., description="The optimization mode that was applied")
     original_length: int = Field(..., description="Length of original text")
     optimized_length: int = Field(..., description="Length of optimized text")
+    usage: Optional[TokenUsage] = Field(None, description="Upstream token usage and cost")
 
 class ChatRequest(BaseModel):
     user_input: str = Field(..., description="The user's input text")
@@ -22,6 +32,7 @@ class ChatResponse(BaseModel):
     improved_prompt: str = Field(..., description="The optimized prompt")
     final_answer: str = Field(..., description="The final response from the target model")
     optimization_mode: str = Field(..., description="The optimization mode that was applied")
+    usage: Optional[TokenUsage] = Field(None, description="Upstream token usage and cost for optimization and answer")
 
 class ModeInfo(BaseModel):
     mode: str = Field(..., description="The optimization mode identifier")
@@ -31,3 +42,41 @@ class ModeInfo(BaseModel):
 
 class AvailableModesResponse(BaseModel):
     modes: List[ModeInfo] = Field(..., description="List of available optimization modes")
+
+class ClientUsage(BaseModel):
+    requests: int = Field(..., description="Number of requests recorded for the client")
+    window_tokens: int = Field(..., description="Tokens used in the current budget window")
+    window_cost_usd: float = Field(..., description="Cost in USD in the current budget window")
+    total_input_tokens: int = Field(..., description="Input tokens used since startup")
+    total_output_tokens: int = Field(..., description="Output tokens used since startup")
+    total_cost_usd: float = Field(..., description="Cost in USD since startup")
+
+class UsageSummaryResponse(BaseModel):
+    clients: Dict[str, ClientUsage] = Field(..., description="Aggregated usage per client")
+
+class CacheStatsResponse(BaseModel):
+    entries: int = Field(..., description="Number of cached optimizations across all modes")
+    hits: int = Field(..., description="Lookups served from the cache")
+    misses: int = Field(..., description="Lookups that went upstream")
+    hit_rate: float = Field(..., description="Fraction of lookups served from the cache")
+    threshold: float = Field(..., description="Similarity threshold for a cache hit")
+    similarity: str = Field(..., description="Similarity backend in use (minhash or embedding)")
+
+class PrefetchRequest(BaseModel):
+    session_id: str = Field(..., description="Identifier of the draft's editor session; a newer draft replaces an older one")
+    text: str = Field(..., description="The current draft to optimize speculatively")
+    mode: Optional[str] = Field("standard", description="Optimization mode to apply")
+
+class PrefetchResponse(BaseModel):
+    accepted: bool = Field(..., description="Whether the draft was queued for prefetch")
+    reason: Optional[str] = Field(None, description="Why the draft was not queued")
+
+class PrefetchStatsResponse(BaseModel):
+    submitted: int = Field(..., description="Drafts queued for prefetch")
+    completed: int = Field(..., description="Prefetch jobs that finished")
+    cancelled: int = Field(..., description="Pending jobs replaced by a newer draft")
+    over_budget: int = Field(..., description="Jobs skipped because the prefetch budget was exhausted")
+    failed: int = Field(..., description="Jobs that failed upstream")
+    pending: int = Field(..., description="Jobs waiting to run")
+    running: int = Field(..., description="Jobs currently running")
+    budget: Dict[str, ClientUsage] = Field(..., description="Prefetch spend, charged to one global key")
@@ -1,6 +1,18 @@
 from .clients import get_openai
+from .cache import semantic_cache, SEMANTIC_CACHE_ENABLED
+from .retry import call_with_retry, skip_fallback
+from .budget import (
+    Reservation, Usage, UsageTracker, usage_tracker, estimate_messages_tokens, choose_optimizer_model,
+    usage_from_response, OPTIMIZER_MAX_OUTPUT_TOKENS, OPTIMIZER_MODEL, FALLBACK_MODEL
+)
 from enum import Enum
-from typing import Optional
+from typing import List, Optional, Tuple
+
+# Client id used when a caller does not identify itself
+DEFAULT_CLIENT_ID = "default"
+
+# Output token cap for the chat completions fallback
+FALLBACK_MAX_TOKENS = 800
 
 class OptimizationMode(Enum):
     STANDARD = "standard"
@@ -109,33 +121,134 @@ def rewrite_prompt(user_input: str, mode: OptimizationMode = OptimizationMode.ST
     Returns:
         An optimized version of the prompt
     """
-    client = get_openai()
-    system_prompt = get_optimization_prompt(mode)
+    improved, _ = rewrite_prompt_with_usage(user_input, mode)
+    return improved
+
+def rewrite_prompt_with_usage(
+    user_input: str,
+    mode: OptimizationMode = OptimizationMode.STANDARD,
+    client_id: str = DEFAULT_CLIENT_ID,
+    use_semantic_cache: bool = True,
+    tracker: Optional[UsageTracker] = None,
+    speculative: bool = False,
+    reservation: Optional[Reservation] = None,
+) -> Tuple[str, Usage]:
+    """
+    Rewrite a user prompt and report the upstream token usage.
+    
+    The input is estimated locally first and oversized inputs are rejected.
+    Near-duplicates of previously optimized prompts are then served from
+    the semantic cache without an upstream call. Otherwise large inputs are
+    routed to the cheap model, and the client's budget is checked before
+    anything is sent upstream.
+    
+    Args:
+        user_input: The original user prompt
+        mode: The optimization mode to apply
+        client_id: Identifier the usage is budgeted and recorded against
+        use_semantic_cache: Whether to consult and populate the semantic cache
+        tracker: Budget the call is charged to (defaults to the shared usage tracker)
+        speculative: Prefetch call; its cache lookup is kept out of the hit
+            rate and its result is cached for exact template matches only
+        reservation: Budget the caller already reserved for this call; when
+            given, no separate reservation is made and the caller settles it
+    
+    Returns:
+        The optimized prompt and the Usage of the upstream call (zero
+        tokens, cached=True for cache hits)
+    
+    Raises:
+        BudgetExceededError: If the input or client budget limits are exceeded
+    """
+    tracker = tracker or usage_tracker
+    # Size check first, so oversized inputs are rejected before they are hashed for the cache
+    messages, model, input_tokens, max_output = plan_rewrite(user_input, mode)
+    use_cache = SEMANTIC_CACHE_ENABLED and use_semantic_cache
+    if use_cache:
+        hit = semantic_cache.lookup(user_input, mode.value, count=not speculative)
+        if hit is not None:
+            return hit.optimized, Usage(model=hit.model, cached=True)
+    
+    own_reservation = None
+    if reservation is None:
+        own_reservation = tracker.check(client_id, model, input_tokens, max_output)
     
     try:
-        # Try Responses API first (for models that support reasoning)
-        resp = client.responses.create(
-            model="o1",  # Use o1 for reasoning capabilities
-            reasoning={"effort": "medium"},  # Medium effort for better optimization
-            input=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Optimize this prompt: {user_input}"},
-            ],
-        )
-        return (resp.output_text or "").strip()
-    except Exception as e:
-        # Fallback to regular chat completions if Responses API fails
-        print(f"Responses API failed, falling back to chat completions: {e}")
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",  # Use a reliable model for fallback
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Optimize this prompt: {user_input}"},
-            ],
-            max_tokens=800,  # Increased for better optimization
-            temperature=0.1,  # Low temperature for consistent quality
-        )
-        return (resp.choices[0].message.content or "").strip()
+        improved, usage = _rewrite_upstream(messages, model, input_tokens, max_output)
+    except BaseException:
+        tracker.release(own_reservation)
+        raise
+    tracker.record(client_id, usage, own_reservation)
+    if use_cache:
+        semantic_cache.store(user_input, mode.value, improved, usage.model, exact_only=speculative)
+    return improved, usage
+
+def plan_rewrite(user_input: str, mode: OptimizationMode) -> Tuple[List[dict], str, int, int]:
+    """
+    Build the optimization request and its worst-case token footprint.
+    
+    Returns:
+        The messages, the model to use, the estimated input tokens and the
+        output token cap
+    
+    Raises:
+        BudgetExceededError: If the input is above MAX_INPUT_TOKENS
+    """
+    messages = [
+        {"role": "system", "content": get_optimization_prompt(mode)},
+        {"role": "user", "content": f"Optimize this prompt: {user_input}"},
+    ]
+    input_tokens = estimate_messages_tokens(messages)
+    model = choose_optimizer_model(input_tokens)
+    max_output = OPTIMIZER_MAX_OUTPUT_TOKENS if model == OPTIMIZER_MODEL else FALLBACK_MAX_TOKENS
+    return messages, model, input_tokens, max_output
+
+def _rewrite_upstream(messages: list, model: str, input_tokens: int, max_output: int) -> Tuple[str, Usage]:
+    """
+    Send the optimization request upstream under the retry policy.
+    
+    Falls back to chat completions when the Responses API call fails for
+    any reason other than auth, quota or a saturated proxy, or comes back incomplete or
+    empty (e.g. reasoning used up max_output_tokens). Spend on an unusable
+    o1 response is still included in the returned Usage.
+    """
+    client = get_openai()
+    wasted = Usage()
+    
+    if model == OPTIMIZER_MODEL:
+        try:
+            # Try Responses API first (for models that support reasoning)
+            resp = call_with_retry(
+                client.responses.create,
+                model=OPTIMIZER_MODEL,  # Use o1 for reasoning capabilities
+                reasoning={"effort": "medium"},  # Medium effort for better optimization
+                input=messages,
+                max_output_tokens=max_output,
+            )
+            improved = (resp.output_text or "").strip()
+            usage = usage_from_response(resp, OPTIMIZER_MODEL, input_tokens, improved)
+            if improved and getattr(resp, "status", None) != "incomplete":
+                return improved, usage
+            wasted = usage
+            reason = getattr(getattr(resp, "incomplete_details", None), "reason", None)
+            print(f"Responses API returned no usable output ({reason or 'empty output'}), falling back to chat completions")
+        except Exception as e:
+            if skip_fallback(e):
+                raise
+            # Fallback to regular chat completions if Responses API fails
+            print(f"Responses API failed, falling back to chat completions: {e}")
+    else:
+        print(f"Input is ~{input_tokens} tokens, routing optimization to {FALLBACK_MODEL}")
+    
+    resp = call_with_retry(
+        client.chat.completions.create,
+        model=FALLBACK_MODEL,  # Use a reliable model for fallback
+        messages=messages,
+        max_tokens=FALLBACK_MAX_TOKENS,  # Increased for better optimization
+        temperature=0.1,  # Low temperature for consistent quality
+    )
+    improved = (resp.choices[0].message.content or "").strip()
+    return improved, wasted + usage_from_response(resp, FALLBACK_MODEL, input_tokens, improved)
 
 def get_available_modes() -> list:
     """Get list of available optimization modes."""
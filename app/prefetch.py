@@ -0,0 +1,206 @@
+"""
+Speculative prompt optimization while the user is still typing.
+
+The extension sends drafts after a typing pause. Each draft becomes a
+low-priority job that warms the semantic cache, so the hotkey request
+finds the optimization already done. Jobs are:
+  - keyed by session, so a newer draft replaces (cancels) an older one,
+  - only started when no interactive request is in flight, and sent
+    upstream as low-priority calls that never take the last free slot,
+  - joined by a matching interactive request only once they hold an
+    upstream slot; a job still queued for one is cancelled instead, so
+    the hotkey never waits behind speculation,
+  - cached for exact template matches only, since the final text may
+    extend the draft with a different intent, and left out of the cache
+    hit rate,
+  - charged to one global prefetch budget shared by all clients, so
+    speculation cannot eat into interactive spend and cannot be scaled
+    up by rotating X-Client-Id.
+"""
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Tuple
+
+from .budget import BudgetExceededError, UsageTracker
+from .optimizer import rewrite_prompt_with_usage, OptimizationMode
+from .retry import CallAbandoned, low_priority
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() not in ("0", "false", "no")
+PREFETCH_MIN_CHARS = int(os.getenv("PREFETCH_MIN_CHARS", "20"))
+PREFETCH_TOKEN_BUDGET = int(os.getenv("PREFETCH_TOKEN_BUDGET", "100000"))
+PREFETCH_COST_BUDGET_USD = float(os.getenv("PREFETCH_COST_BUDGET_USD", "1.0"))
+PREFETCH_BUDGET_WINDOW_SECONDS = int(os.getenv("PREFETCH_BUDGET_WINDOW_SECONDS", "86400"))
+# How long an interactive request waits for a matching in-flight prefetch
+PREFETCH_JOIN_TIMEOUT_SECONDS = float(os.getenv("PREFETCH_JOIN_TIMEOUT_SECONDS", "30"))
+# Client ids are caller-chosen, so all prefetch spend is charged to one key
+PREFETCH_BUDGET_KEY = "prefetch"
+
+
+@dataclass
+class PrefetchJob:
+    session_id: str
+    text: str
+    mode: OptimizationMode
+    client_id: str
+    cancelled: bool = False
+    # Set once the job holds an upstream slot; only then is it worth joining
+    upstream: bool = False
+    done: threading.Event = field(default_factory=threading.Event)
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.mode.value, self.text.strip()
+
+
+class PrefetchScheduler:
+    """Single low-priority worker that optimizes drafts into the cache."""
+
+    def __init__(
+        self,
+        optimize_fn: Callable = rewrite_prompt_with_usage,
+        tracker: Optional[UsageTracker] = None,
+        min_chars: int = PREFETCH_MIN_CHARS,
+        start_worker: bool = True,
+    ):
+        self.optimize_fn = optimize_fn
+        self.tracker = tracker or UsageTracker(
+            token_budget=PREFETCH_TOKEN_BUDGET,
+            cost_budget_usd=PREFETCH_COST_BUDGET_USD,
+            window_seconds=PREFETCH_BUDGET_WINDOW_SECONDS,
+        )
+        self.min_chars = min_chars
+        self.start_worker = start_worker
+        self._pending: "OrderedDict[str, PrefetchJob]" = OrderedDict()
+        self._running: Dict[Tuple[str, str], PrefetchJob] = {}
+        self._interactive = 0
+        self._cond = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self.stats = {"submitted": 0, "completed": 0, "cancelled": 0, "over_budget": 0, "failed": 0}
+
+    def submit(self, session_id: str, text: str, mode: OptimizationMode, client_id: str) -> Optional[PrefetchJob]:
+        """
+        Queue a draft for speculative optimization.
+
+        Replaces any pending draft from the same session. Returns None when
+        the draft is too short to be worth optimizing (which also cancels
+        the session's pending job).
+        """
+        with self._cond:
+            self._cancel_locked(session_id)
+            if len(text.strip()) < self.min_chars:
+                return None
+            job = PrefetchJob(session_id, text, mode, client_id)
+            self._pending[session_id] = job
+            self.stats["submitted"] += 1
+            self._ensure_worker()
+            self._cond.notify_all()
+            return job
+
+    def cancel(self, session_id: str) -> None:
+        with self._cond:
+            self._cancel_locked(session_id)
+
+    def _cancel_locked(self, session_id: str) -> None:
+        job = self._pending.pop(session_id, None)
+        if job is not None:
+            job.cancelled = True
+            job.done.set()
+            self.stats["cancelled"] += 1
+
+    @contextmanager
+    def interactive(self):
+        """Mark an interactive request in flight; prefetch jobs wait until it ends."""
+        with self._cond:
+            self._interactive += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._interactive -= 1
+                self._cond.notify_all()
+
+    def wait_for(self, text: str, mode: OptimizationMode, timeout: float = PREFETCH_JOIN_TIMEOUT_SECONDS) -> bool:
+        """
+        Wait for an in-flight prefetch of the same draft, so its result is reused.
+
+        Only a job already holding an upstream slot is joined. A job still
+        waiting for one (e.g. held back after a 429) is cancelled, and the
+        caller makes the call itself at interactive priority.
+        """
+        with self._cond:
+            job = self._running.get((mode.value, text.strip()))
+            if job is None:
+                return False
+            if not job.upstream:
+                if not job.cancelled:
+                    job.cancelled = True
+                    self.stats["cancelled"] += 1
+                return False
+        return job.done.wait(timeout)
+
+    def _on_slot(self, job: PrefetchJob) -> None:
+        with self._cond:
+            if job.cancelled:
+                raise CallAbandoned(f"Prefetch for session {job.session_id} was cancelled")
+            job.upstream = True
+
+    def _ensure_worker(self) -> None:
+        if self.start_worker and (self._worker is None or not self._worker.is_alive()):
+            self._worker = threading.Thread(target=self._work_forever, name="prefetch-worker", daemon=True)
+            self._worker.start()
+
+    def _next_job(self, block: bool) -> Optional[PrefetchJob]:
+        with self._cond:
+            ready = lambda: self._pending and self._interactive == 0
+            if block:
+                self._cond.wait_for(ready)
+            elif not ready():
+                return None
+            _, job = self._pending.popitem(last=False)
+            self._running[job.key] = job
+            return job
+
+    def _execute(self, job: PrefetchJob) -> None:
+        try:
+            with low_priority(on_slot=lambda: self._on_slot(job)):
+                self.optimize_fn(job.text, job.mode, PREFETCH_BUDGET_KEY, tracker=self.tracker, speculative=True)
+            self.stats["completed"] += 1
+        except CallAbandoned:
+            pass
+        except BudgetExceededError as e:
+            self.stats["over_budget"] += 1
+            print(f"Skipping prefetch for session {job.session_id} (client {job.client_id}): {e}")
+        except Exception as e:
+            self.stats["failed"] += 1
+            print(f"Prefetch failed for session {job.session_id}: {e}")
+        finally:
+            with self._cond:
+                self._running.pop(job.key, None)
+            job.done.set()
+
+    def run_once(self) -> bool:
+        """Run the next job if one is ready and no interactive request is in flight."""
+        job = self._next_job(block=False)
+        if job is None:
+            return False
+        self._execute(job)
+        return True
+
+    def _work_forever(self) -> None:
+        while True:
+            self._execute(self._next_job(block=True))
+
+    def summary(self) -> dict:
+        with self._cond:
+            return {
+                **self.stats,
+                "pending": len(self._pending),
+                "running": len(self._running),
+                "budget": self.tracker.summary(),
+            }
+
+
+prefetch_scheduler = PrefetchScheduler()
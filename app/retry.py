@@ -0,0 +1,446 @@
+"""
+Retry policy and adaptive concurrency for upstream OpenAI calls.
+
+Errors are classified as retryable (429, 5xx, timeouts, connection
+errors) or fatal (400, auth, not found, a 429 for exhausted quota). Retryable errors are retried with
+jittered exponential backoff, honoring Retry-After and the x-ratelimit-*
+reset headers, as long as the global retry budget allows it. Every call
+also holds a slot in an AIMD concurrency limiter that halves its limit on
+429s and grows back on success, so bursts queue instead of failing.
+Streams hold their slot until they are fully read.
+Low-priority (speculative) calls leave slots free for interactive ones.
+"""
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+
+import openai
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_WAIT_SECONDS = float(os.getenv("RETRY_BASE_WAIT_SECONDS", "0.5"))
+RETRY_MAX_WAIT_SECONDS = float(os.getenv("RETRY_MAX_WAIT_SECONDS", "20"))
+
+# Retries may add at most this fraction of extra load, plus a small steady allowance
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "1"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "20"))
+
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "8"))
+UPSTREAM_MIN_CONCURRENCY = int(os.getenv("UPSTREAM_MIN_CONCURRENCY", "1"))
+UPSTREAM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT_SECONDS", "60"))
+# A burst of concurrent 429s halves the concurrency limit only once per window
+RATE_LIMIT_COOLDOWN_SECONDS = float(os.getenv("RATE_LIMIT_COOLDOWN_SECONDS", "2"))
+# Slots low-priority calls must leave free for interactive calls
+UPSTREAM_RESERVED_INTERACTIVE_SLOTS = int(os.getenv("UPSTREAM_RESERVED_INTERACTIVE_SLOTS", "1"))
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+AUTH_STATUS_CODES = {401, 403}
+# 429 codes that mean billing failure rather than rate limiting
+QUOTA_ERROR_CODES = {"insufficient_quota", "billing_hard_limit_reached"}
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class CallAbandoned(Exception):
+    """Raised by a low-priority on_slot hook to drop a call before it is sent upstream."""
+
+
+class UpstreamBusyError(Exception):
+    """Raised when no upstream concurrency slot frees up in time."""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def _error_code(exc: BaseException) -> Optional[str]:
+    code = getattr(exc, "code", None)
+    if code is None:
+        body = getattr(exc, "body", None)
+        if isinstance(body, dict):
+            error = body.get("error", body)
+            code = error.get("code") if isinstance(error, dict) else None
+    return code if isinstance(code, str) else None
+
+
+def is_quota_exhausted(exc: BaseException) -> bool:
+    """A 429 for an exhausted quota is a billing failure; waiting will not fix it."""
+    return _status_code(exc) == 429 and _error_code(exc) in QUOTA_ERROR_CODES
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Whether an upstream error is transient and worth retrying."""
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError, TimeoutError)):
+        return True
+    if is_quota_exhausted(exc):
+        return False
+    status = _status_code(exc)
+    return status is not None and (status in RETRYABLE_STATUS_CODES or status >= 500)
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    return _status_code(exc) == 429 and not is_quota_exhausted(exc)
+
+
+def is_auth_error(exc: BaseException) -> bool:
+    """Auth failures are fatal for every model, so falling back is pointless."""
+    return _status_code(exc) in AUTH_STATUS_CODES
+
+
+def skip_fallback(exc: BaseException) -> bool:
+    """
+    Whether a fallback call would fail the same way: auth or quota errors,
+    or a saturated proxy (which also covers a 429 whose Retry-After was too
+    long to wait for), where the fallback would only queue again. An
+    abandoned low-priority call is not retried with another model either.
+    """
+    return is_auth_error(exc) or is_quota_exhausted(exc) or isinstance(exc, (UpstreamBusyError, CallAbandoned))
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Parse rate-limit reset values such as "20ms", "1s" or "6m0s"."""
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """
+    How long upstream asked us to wait, from the error response headers.
+
+    Checks retry-after-ms, Retry-After (seconds or HTTP date), then the
+    x-ratelimit-reset-* header for whichever limit is exhausted.
+    """
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    waits = []
+    for kind in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            reset = headers.get(f"x-ratelimit-reset-{kind}")
+            if reset and _parse_duration(reset) is not None:
+                waits.append(_parse_duration(reset))
+    return max(waits) if waits else None
+
+
+class RetryBudget:
+    """
+    Global cap on retries across all requests.
+
+    Each request deposits RETRY_BUDGET_RATIO of a retry and each retry
+    withdraws one, so under sustained failure retries add at most that
+    fraction of extra load instead of multiplying it.
+    """
+
+    def __init__(
+        self,
+        ratio: float = RETRY_BUDGET_RATIO,
+        min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND,
+        max_tokens: float = RETRY_BUDGET_MAX,
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    @property
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+_priority = threading.local()
+
+
+@contextmanager
+def low_priority(on_slot: Optional[Callable[[], None]] = None):
+    """
+    Mark upstream calls made by this thread as low priority (e.g. prefetch).
+
+    on_slot runs each time one of these calls gets an upstream slot, right
+    before it is sent; it may raise CallAbandoned to drop the call.
+    """
+    previous = getattr(_priority, "low", False), getattr(_priority, "on_slot", None)
+    _priority.low, _priority.on_slot = True, on_slot
+    try:
+        yield
+    finally:
+        _priority.low, _priority.on_slot = previous
+
+
+def is_low_priority() -> bool:
+    return getattr(_priority, "low", False)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on concurrent upstream calls.
+
+    The limit grows by one slot per limit's worth of successes and halves
+    on a 429, at most once per cooldown window so a burst of concurrent
+    429s counts as one signal. It never leaves [min_limit, max_limit].
+    Callers over the limit wait for a slot instead of hitting upstream.
+    Low-priority callers only get a slot while the limit is at its maximum
+    and `reserved` slots stay free for interactive callers.
+    """
+
+    def __init__(
+        self,
+        max_limit: int = UPSTREAM_MAX_CONCURRENCY,
+        min_limit: int = UPSTREAM_MIN_CONCURRENCY,
+        queue_timeout: float = UPSTREAM_QUEUE_TIMEOUT_SECONDS,
+        cooldown: float = RATE_LIMIT_COOLDOWN_SECONDS,
+        reserved: int = UPSTREAM_RESERVED_INTERACTIVE_SLOTS,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.queue_timeout = queue_timeout
+        self.cooldown = cooldown
+        self.reserved = reserved
+        self._limit = float(max_limit)
+        self._in_flight = 0
+        self._last_decrease: Optional[float] = None
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _has_free_slot(self, low: bool) -> bool:
+        if not low:
+            return self._in_flight < self.limit
+        # Speculative calls back off entirely while upstream is rate limiting us
+        return self.limit >= self.max_limit and self._in_flight < self.limit - self.reserved
+
+    def acquire(self, low: Optional[bool] = None) -> None:
+        """Take one upstream slot, waiting up to queue_timeout; pair with release()."""
+        low = is_low_priority() if low is None else low
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._has_free_slot(low), timeout=self.queue_timeout):
+                raise UpstreamBusyError("Upstream is rate limited, too many requests queued")
+            self._in_flight += 1
+        on_slot = getattr(_priority, "on_slot", None) if low else None
+        if on_slot is not None:
+            try:
+                on_slot()
+            except BaseException:
+                self.release()
+                raise
+
+    def release(self) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, low: Optional[bool] = None):
+        """Hold one upstream slot for the duration of the block."""
+        self.acquire(low)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def on_success(self) -> None:
+        with self._cond:
+            self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+    def on_rate_limited(self) -> None:
+        with self._cond:
+            now = time.monotonic()
+            if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self._limit = max(float(self.min_limit), self._limit / 2)
+            print(f"Upstream returned 429, concurrency limit reduced to {self.limit}")
+
+
+class _wait_retry_after:
+    """Wait for Retry-After when upstream sent one, else jittered exponential backoff."""
+
+    def __init__(self, base: float, max_wait: float):
+        self.backoff = wait_random_exponential(multiplier=base, max=max_wait)
+
+    def __call__(self, retry_state) -> float:
+        exc = retry_state.outcome.exception()
+        requested = retry_after_seconds(exc) if exc is not None else None
+        if requested is not None:
+            return requested
+        return self.backoff(retry_state)
+
+
+class RetryPolicy:
+    """Unified retry and concurrency policy for upstream calls."""
+
+    def __init__(
+        self,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        base_wait: float = RETRY_BASE_WAIT_SECONDS,
+        max_wait: float = RETRY_MAX_WAIT_SECONDS,
+        budget: Optional[RetryBudget] = None,
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.max_attempts = max_attempts
+        self.base_wait = base_wait
+        self.max_wait = max_wait
+        self.budget = budget or RetryBudget()
+        self.limiter = limiter or AdaptiveConcurrencyLimiter()
+        self.sleep = sleep
+
+    def _stop_when_wait_too_long(self, retry_state) -> bool:
+        # Retrying before upstream's Retry-After would just earn another 429
+        exc = retry_state.outcome.exception()
+        requested = retry_after_seconds(exc) if exc is not None else None
+        if requested is not None and requested > self.max_wait:
+            print(f"Upstream asked to wait {requested:.1f}s (> {self.max_wait:.1f}s), not retrying")
+            return True
+        return False
+
+    def _stop_when_budget_exhausted(self, retry_state) -> bool:
+        if self.budget.try_withdraw():
+            return False
+        print("Retry budget exhausted, not retrying upstream call")
+        return True
+
+    @staticmethod
+    def _log_retry(retry_state) -> None:
+        exc = retry_state.outcome.exception()
+        print(f"Upstream call failed ({exc.__class__.__name__}), retry {retry_state.attempt_number} "
+              f"in {retry_state.next_action.sleep:.2f}s")
+
+    def _retrying(self) -> Retrying:
+        return Retrying(
+            sleep=self.sleep,
+            stop=(stop_after_attempt(self.max_attempts)
+                  | self._stop_when_wait_too_long
+                  | self._stop_when_budget_exhausted),
+            wait=_wait_retry_after(self.base_wait, self.max_wait),
+            retry=retry_if_exception(is_retryable),
+            before_sleep=self._log_retry,
+            reraise=True,
+        )
+
+    def _open(self, fn: Callable, args: tuple, kwargs: dict):
+        """
+        Call fn with retries, returning its result while still holding its slot.
+
+        A 429 whose Retry-After is longer than max_wait is raised as
+        UpstreamBusyError, so callers answer 503 instead of falling back.
+        """
+        self.budget.deposit()
+        try:
+            for attempt in self._retrying():
+                with attempt:
+                    self.limiter.acquire()
+                    try:
+                        result = fn(*args, **kwargs)
+                    except Exception as e:
+                        self.limiter.release()
+                        if is_rate_limited(e):
+                            self.limiter.on_rate_limited()
+                        raise
+                    self.limiter.on_success()
+                    return result
+        except Exception as e:
+            requested = retry_after_seconds(e) if is_rate_limited(e) else None
+            if requested is not None and requested > self.max_wait:
+                raise UpstreamBusyError("Upstream is rate limited", retry_after=requested) from e
+            raise
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """
+        Call fn with retries, backoff and a concurrency slot.
+
+        Re-raises the last error when it is fatal, attempts run out, or the
+        retry budget is exhausted. Raises UpstreamBusyError when upstream
+        asks for a longer wait than max_wait.
+        """
+        result = self._open(fn, args, kwargs)
+        self.limiter.release()
+        return result
+
+    @contextmanager
+    def stream(self, fn: Callable, *args, **kwargs):
+        """
+        Open a stream with fn under the same retry policy, and keep its
+        concurrency slot until the block exits, so streams being read count
+        against the adaptive limit.
+        """
+        stream = self._open(fn, args, kwargs)
+        try:
+            yield stream
+        finally:
+            self.limiter.release()
+            close = getattr(stream, "close", None)
+            if callable(close):
+                close()
+
+
+retry_policy = RetryPolicy()
+
+
+def call_with_retry(fn: Callable, *args, **kwargs):
+    """Call an upstream function under the shared retry policy."""
+    return retry_policy.call(fn, *args, **kwargs)
+
+
+def stream_with_retry(fn: Callable, *args, **kwargs):
+    """Open an upstream stream under the shared retry policy, holding a slot while it is read."""
+    return retry_policy.stream(fn, *args, **kwargs)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Local evaluation of the semantic prompt cache.
+
+Seeds the cache with a set of base prompts, then looks up paraphrased
+variants and reports hit rate and quality for each similarity threshold.
+No API calls are made. Optimizations are simulated deterministically and,
+like the real optimizer, reword details and elaborate on what the prompt
+names: small numbers are spelled out, email addresses and filler words
+are dropped, and known entities (languages, companies) get entity-specific
+guidance. A correct cache hit must reproduce what optimizing the variant
+directly would have produced, so the quality column catches hits that
+leak the cached prompt's details, such as French grammar notes served
+for a Spanish translation.
+
+The long cases differ from their base prompt by a single word, so their
+MinHash similarity is above the default threshold; they check that the
+cache does not serve a prompt whose meaning changed.
+
+Usage:
+    python eval_semantic_cache.py
+    python eval_semantic_cache.py --thresholds 0.8 0.9 0.95
+"""
+import argparse
+import re
+
+from app.cache import SemanticCache, normalize, SEMANTIC_CACHE_THRESHOLD
+
+ESSAY = "Write a persuasive essay arguing that remote work is good for productivity and employee wellbeing"
+SORT = "Write a Python function that sorts a list of customer records by signup date in ascending order"
+HASH_MAP = "Explain how a hash map handles collisions when two keys land in the same bucket"
+
+# (base prompt, variant, whether the variant should be served from cache)
+CASES = [
+    ("Summarize this email from Bob", "Summarize this email from Alice.", True),
+    ("Summarize this email from Bob", "Summarize   this email from Carol!!", True),
+    ("Explain recursion", "explain recursion?", True),
+    ("Explain recursion", "EXPLAIN RECURSION", True),
+    ("Fix this code in Python", "fix this code in python", True),
+    ("Explain recursion", "Can you explain recursion", True),
+    ("Explain how binary search works", "Please explain how binary search works", True),
+    ("Write a short story about a dragon", "Write a short story about the dragon", True),
+    ("List 5 tips for learning Python", "List 10 tips for learning Rust", True),
+    ("Write 3 paragraphs about dogs", "Write 300 paragraphs about dogs", True),
+    ("Write a cover letter for a job at Google", "Write a cover letter for a job at Microsoft", True),
+    ("Translate this paragraph into French", "Translate this paragraph into Spanish", True),
+    ("Compare Python and Rust for a CLI tool", "Compare Rust and Python for a CLI tool", True),
+    ("Email jane@example.com about the 3pm meeting", "Email joe@example.org about the 4pm meeting", True),
+    ("Explain how binary search works", "Explain how binary search works with an example", False),
+    ("Explain recursion", "Explain dynamic programming", False),
+    ("Write a haiku about autumn", "Write a limerick about autumn", False),
+    ("Summarize this email from Bob", "Reply to this email from Bob", False),
+    ("Summarize this email from Bob", "summarize this email from alice", True),
+    ("Give me a workout plan for beginners", "Give me a meal plan for beginners", False),
+    ("How do I reverse a list in Python?", "How do I sort a list in Python?", False),
+    (ESSAY, ESSAY.replace("is good", "is not good"), False),
+    (SORT, SORT.replace("ascending", "descending"), False),
+    (HASH_MAP, HASH_MAP + " formally", False),
+    (HASH_MAP, HASH_MAP.replace("two keys", "three keys"), False),
+    (SORT, "Please write a Python function that sorts the list of customer records by signup date in ascending order", True),
+    (HASH_MAP, "Can you explain how a hash map handles collisions when two keys land in the same bucket?", True),
+    ("Explain recursion and iteration with examples", "Explain iteration and recursion with examples", True),
+]
+
+MODE = "standard"
+
+
+NUMBER_WORDS = dict(zip("123456789", ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine"]))
+FILLER_RE = re.compile(r"\b(?:please|can you|could you|the|a)\b\s*", re.IGNORECASE)
+
+# Guidance the optimizer adds about what the prompt names; a slot swap cannot rewrite it
+ENTITY_NOTES = {
+    "python": "Follow PEP 8 and use type hints.",
+    "rust": "Handle errors with Result and avoid unwrap.",
+    "french": "Use the formal vous form and keep gendered agreements.",
+    "spanish": "Use usted and keep regional vocabulary neutral.",
+    "google": "Highlight large-scale distributed systems experience.",
+    "microsoft": "Highlight enterprise software and cloud experience.",
+}
+
+
+def simulated_optimize(prompt: str) -> str:
+    """Stand-in for the upstream optimizer that rewords details and elaborates on named entities."""
+    body = re.sub(r"[\w.+-]+@[\w-]+\.[\w.-]+", "the recipient", prompt.strip())
+    body = re.sub(r"\b[1-9]\b", lambda m: NUMBER_WORDS[m.group(0)], body)
+    body = FILLER_RE.sub("", body).rstrip("?!. ")
+    notes = [note for entity, note in ENTITY_NOTES.items() if re.search(rf"\b{entity}\b", prompt, re.IGNORECASE)]
+    return " ".join([f"Complete the following task step by step, with a clearly labeled final answer: {body}.", *notes])
+
+
+def evaluate(threshold: float) -> dict:
+    cache = SemanticCache(threshold=threshold)
+    for base in dict.fromkeys(base for base, _, _ in CASES):
+        cache.store(base, MODE, simulated_optimize(base))
+
+    true_hits = false_hits = missed = correct = 0
+    missed_variants, leaked_variants = [], []
+    for _, variant, should_hit in CASES:
+        hit = cache.lookup(variant, MODE)
+        if hit is None:
+            if should_hit:
+                missed += 1
+                missed_variants.append(variant)
+            continue
+        if should_hit:
+            true_hits += 1
+        else:
+            false_hits += 1
+        if normalize(hit.optimized) == normalize(simulated_optimize(variant)):
+            correct += 1
+        else:
+            leaked_variants.append(variant)
+
+    hits = true_hits + false_hits
+    expected_hits = sum(should_hit for _, _, should_hit in CASES)
+    return {
+        "threshold": threshold,
+        "hit_rate": hits / len(CASES),
+        "precision": true_hits / hits if hits else 1.0,
+        "recall": true_hits / expected_hits if expected_hits else 1.0,
+        "quality": correct / hits if hits else 1.0,
+        "false_hits": false_hits,
+        "missed": missed,
+        "missed_variants": missed_variants,
+        "leaked_variants": leaked_variants,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate semantic cache hit rate and quality")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.6, 0.7, 0.8, 0.9, 1.0])
+    args = parser.parse_args()
+
+    print(f"{len(CASES)} lookups against {len({b for b, _, _ in CASES})} cached prompts\n")
+    print(f"{'threshold':>9}  {'hit rate':>8}  {'precision':>9}  {'recall':>6}  {'quality':>7}  {'false hits':>10}  {'missed':>6}")
+    for threshold in args.thresholds:
+        r = evaluate(threshold)
+        print(
+            f"{r['threshold']:>9.2f}  {r['hit_rate']:>8.1%}  {r['precision']:>9.1%}  {r['recall']:>6.1%}"
+            f"  {r['quality']:>7.1%}  {r['false_hits']:>10}  {r['missed']:>6}"
+        )
+    print("\nquality = fraction of hits whose returned prompt matches optimizing the variant directly")
+
+    configured = evaluate(SEMANTIC_CACHE_THRESHOLD)
+    print(f"\nMissed at the configured threshold ({SEMANTIC_CACHE_THRESHOLD}):")
+    for variant in configured["missed_variants"]:
+        print(f"  - {variant}")
+    print("\nHits that leaked the cached prompt's details:")
+    for variant in configured["leaked_variants"]:
+        print(f"  - {variant}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 // Backend endpoint for optimization:
 const OPTIMIZER_URL = "http://localhost:8000/optimize";
+// Backend endpoint for speculative optimization while typing:
+const PREFETCH_URL = "http://localhost:8000/prefetch";
 
 chrome.runtime.onMessage.addListener((msg, sender, sendResponse) => {
   if (msg?.type === "OPTIMIZE_PROMPT") {
@@ -51,6 +53,24 @@ chrome.runtime.onMessage.addListener((msg, sender, sendResponse) => {
     return true; // keep channel open for async response
   }
   
+  // Handle speculative prefetch of drafts (fire-and-forget)
+  if (msg?.type === "PREFETCH_PROMPT") {
+    fetch(PREFETCH_URL, {
+      method: "POST",
+      headers: {"Content-Type": "application/json"},
+      body: JSON.stringify({
+        session_id: msg.session_id,
+        text: msg.text || "",
+        mode: msg.mode || "standard"
+      })
+    })
+      .then(r => r.ok ? r.json() : null)
+      .then(data => sendResponse({ ok: !!data?.accepted, reason: data?.reason }))
+      .catch(err => sendResponse({ ok: false, error: err.message || "Network error" }));
+    
+    return true; // keep channel open for async response
+  }
+  
   // Handle PING messages for context checking
   if (msg?.type === "PING") {
     sendResponse({ ok: true, message: "pong" });
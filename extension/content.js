@@ -278,6 +278,61 @@ function showModeChangeNotification(mode) {
   }, 3000);
 }
 
+// Prefetch: send the draft to the backend after a typing pause so the
+// hotkey finds the optimization already cached (opt-in via the popup)
+const PREFETCH_DEBOUNCE_MS = 1500;
+const PREFETCH_MIN_CHARS = 20;
+const prefetchSessionId = `tab-${Date.now()}-${Math.random().toString(36).slice(2, 10)}`;
+let prefetchEnabled = false;
+let prefetchTimer = null;
+let lastPrefetchedDraft = '';
+
+function initializePrefetchSetting() {
+  chrome.storage.local.get(['prefetch_enabled'], (result) => {
+    prefetchEnabled = !!result.prefetch_enabled;
+    console.log('🔧 Prefetch while typing:', prefetchEnabled ? 'on' : 'off');
+  });
+  
+  chrome.storage.onChanged.addListener((changes, namespace) => {
+    if (namespace === 'local' && changes.prefetch_enabled) {
+      prefetchEnabled = !!changes.prefetch_enabled.newValue;
+      console.log(`🔄 Prefetch while typing turned ${prefetchEnabled ? 'on' : 'off'}`);
+    }
+  });
+}
+
+function sendPrefetch(text) {
+  if (!chrome.runtime || !chrome.runtime.sendMessage) return;
+  chrome.runtime.sendMessage({
+    type: "PREFETCH_PROMPT",
+    session_id: prefetchSessionId,
+    text: text,
+    mode: currentOptimizationMode
+  }, (resp) => {
+    if (chrome.runtime.lastError) return;
+    if (resp?.ok) {
+      console.log(`Prefetch queued (${text.length} chars, ${currentOptimizationMode} mode)`);
+    }
+  });
+}
+
+document.addEventListener("input", (e) => {
+  if (!prefetchEnabled || isOptimizing) return;
+  
+  const target = e.target;
+  if (!(target.tagName === 'TEXTAREA' || target.isContentEditable)) return;
+  
+  clearTimeout(prefetchTimer);
+  prefetchTimer = setTimeout(() => {
+    if (isOptimizing) return;
+    const draft = target.tagName === 'TEXTAREA' ? target.value.trim() : (target.textContent || target.innerText || "").trim();
+    if (draft === lastPrefetchedDraft) return;
+    lastPrefetchedDraft = draft;
+    // Short drafts are sent too, so the backend cancels any stale pending job
+    sendPrefetch(draft.length >= PREFETCH_MIN_CHARS ? draft : "");
+  }, PREFETCH_DEBOUNCE_MS);
+}, true);
+
 // Global event listener to block Enter keys during optimization
 document.addEventListener("keydown", (e) => {
   if (isOptimizing && e.key === 'Enter') {
@@ -351,6 +406,7 @@ document.addEventListener("keydown", async (e) => {
   
   console.log("Starting optimization...");
   isOptimizing = true;
+  clearTimeout(prefetchTimer);
   
   try {
     // Temporarily disable the send button to prevent accidental sends
@@ -546,6 +602,7 @@ console.log("Press Cmd+Shift+\\ (Mac) or Ctrl+Shift+\\ (Windows/Linux) to optimi
 
 // Initialize mode monitoring for real-time updates
 initializeModeMonitoring();
+initializePrefetchSetting();
 
 // Check backend status on load
 setTimeout(async () => {
@@ -0,0 +1,13 @@
+import pytest
+from app.budget import usage_tracker
+from app.cache import semantic_cache
+
+
+@pytest.fixture(autouse=True)
+def reset_shared_state():
+    """Keep usage totals and cached optimizations from leaking between tests"""
+    usage_tracker.reset()
+    semantic_cache.clear()
+    yield
+    usage_tracker.reset()
+    semantic_cache.clear()
@@ -0,0 +1,207 @@
+"""
+Tests for token estimation, budgets and usage accounting
+"""
+
+import pytest
+from unittest.mock import Mock, patch
+from fastapi.testclient import TestClient
+from app.main import app
+from app.optimizer import rewrite_prompt_with_usage
+from app.budget import (
+    BudgetExceededError, Usage, UsageTracker, estimate_tokens,
+    estimate_cost, usage_from_response, choose_optimizer_model,
+    MAX_INPUT_TOKENS, CHEAP_ROUTE_INPUT_TOKENS, OPTIMIZER_MODEL, FALLBACK_MODEL
+)
+
+client = TestClient(app)
+
+
+class TestEstimation:
+    """Test local token and cost estimation"""
+
+    def test_estimate_tokens(self):
+        assert estimate_tokens("") == 0
+        assert estimate_tokens("hello world") > 0
+        assert estimate_tokens("word " * 1000) > estimate_tokens("word " * 10)
+
+    @patch('app.budget.tiktoken', None)
+    def test_fallback_estimate_is_conservative_for_non_ascii(self):
+        assert estimate_tokens("a" * 400) == 100
+        # CJK text is at least a token per character, so chars / 4 would undercount
+        assert estimate_tokens("你好" * 100) >= 200
+
+    def test_estimate_cost(self):
+        assert estimate_cost("gpt-4o-mini", 1_000_000, 0) == pytest.approx(0.15)
+        assert estimate_cost("o1", 0, 1_000_000) == pytest.approx(60.00)
+        assert estimate_cost("o1", 1000, 1000) > estimate_cost("gpt-4o-mini", 1000, 1000)
+
+    def test_model_routing(self):
+        assert choose_optimizer_model(100) == OPTIMIZER_MODEL
+        assert choose_optimizer_model(CHEAP_ROUTE_INPUT_TOKENS + 1) == FALLBACK_MODEL
+        with pytest.raises(BudgetExceededError) as exc:
+            choose_optimizer_model(MAX_INPUT_TOKENS + 1)
+        assert exc.value.status_code == 413
+
+
+class TestUsageAccounting:
+    """Test usage extraction and per-client budgets"""
+
+    def test_usage_from_responses_api(self):
+        resp = Mock()
+        resp.usage = Mock(input_tokens=120, output_tokens=300)
+        usage = usage_from_response(resp, "o1")
+        assert usage.input_tokens == 120
+        assert usage.output_tokens == 300
+        assert usage.total_tokens == 420
+        assert not usage.estimated
+
+    def test_usage_from_chat_completions(self):
+        resp = Mock()
+        resp.usage = Mock(spec=["prompt_tokens", "completion_tokens"], prompt_tokens=50, completion_tokens=70)
+        usage = usage_from_response(resp, "gpt-4o-mini")
+        assert usage.input_tokens == 50
+        assert usage.output_tokens == 70
+
+    def test_usage_falls_back_to_estimate(self):
+        usage = usage_from_response(None, "gpt-4o", fallback_input=10, fallback_output_text="some answer text")
+        assert usage.input_tokens == 10
+        assert usage.output_tokens > 0
+        assert usage.estimated
+
+    def test_client_token_budget(self):
+        tracker = UsageTracker(token_budget=1000, cost_budget_usd=0, max_request_cost_usd=0)
+        tracker.check("a", "gpt-4o-mini", 500, 100)
+        tracker.record("a", Usage(input_tokens=500, output_tokens=400))
+        with pytest.raises(BudgetExceededError) as exc:
+            tracker.check("a", "gpt-4o-mini", 200, 100)
+        assert exc.value.status_code == 429
+        # Other clients are unaffected
+        tracker.check("b", "gpt-4o-mini", 200, 100)
+
+    def test_token_budget_counts_worst_case_output(self):
+        tracker = UsageTracker(token_budget=1000, cost_budget_usd=0, max_request_cost_usd=0)
+        with pytest.raises(BudgetExceededError):
+            tracker.check("a", "gpt-4o-mini", 100, 4000)
+
+    def test_combined_calls_checked_together(self):
+        tracker = UsageTracker(token_budget=1000, cost_budget_usd=0, max_request_cost_usd=0)
+        tracker.check_calls("a", [("gpt-4o-mini", 200, 200)])
+        with pytest.raises(BudgetExceededError):
+            tracker.check_calls("a", [("gpt-4o-mini", 200, 200), ("gpt-4o", 300, 400)])
+
+    def test_concurrent_checks_see_reservations(self):
+        tracker = UsageTracker(token_budget=1000, cost_budget_usd=0, max_request_cost_usd=0)
+        first = tracker.check("a", "gpt-4o-mini", 300, 300)
+        # The first call has not been recorded yet, but its worst case is held
+        with pytest.raises(BudgetExceededError):
+            tracker.check("a", "gpt-4o-mini", 300, 300)
+
+        tracker.record("a", Usage(input_tokens=300, output_tokens=50), first)
+        second = tracker.check("a", "gpt-4o-mini", 300, 300)
+        tracker.release(second)
+        tracker.release(second)
+        tracker.check("a", "gpt-4o-mini", 300, 300)
+
+    def test_failed_rewrite_releases_reservation(self):
+        tracker = UsageTracker(token_budget=20000, cost_budget_usd=0, max_request_cost_usd=0)
+        with patch('app.optimizer._rewrite_upstream', side_effect=RuntimeError("upstream down")):
+            for _ in range(3):
+                with pytest.raises(RuntimeError):
+                    rewrite_prompt_with_usage("explain recursion", client_id="a", use_semantic_cache=False, tracker=tracker)
+        assert tracker.summary()["a"]["window_tokens"] == 0
+        tracker.check("a", "gpt-4o-mini", 1000, 18000)
+
+    def test_ledgers_are_bounded(self):
+        tracker = UsageTracker(max_ledgers=2)
+        for client_id in ("a", "b", "c"):
+            tracker.record(client_id, Usage(input_tokens=10))
+        assert set(tracker.summary()) == {"b", "c"}
+
+    def test_per_request_cost_limit(self):
+        tracker = UsageTracker(max_request_cost_usd=0.01)
+        with pytest.raises(BudgetExceededError) as exc:
+            tracker.check("a", "o1", 1000, 4000)
+        assert exc.value.status_code == 413
+
+
+class TestBudgetEndpoints:
+    """Test usage reporting through the API"""
+
+    @patch('app.optimizer.get_openai')
+    def test_optimize_returns_and_aggregates_usage(self, mock_get_openai):
+        mock_client = Mock()
+        mock_response = Mock()
+        mock_response.output_text = "Improved prompt."
+        mock_response.usage = Mock(input_tokens=200, output_tokens=800)
+        mock_client.responses.create.return_value = mock_response
+        mock_get_openai.return_value = mock_client
+
+        response = client.post("/optimize", json={"text": "test prompt"}, headers={"X-Client-Id": "tester"})
+        assert response.status_code == 200
+        usage = response.json()["usage"]
+        assert usage["input_tokens"] == 200
+        assert usage["output_tokens"] == 800
+        assert usage["model"] == "o1"
+        assert mock_client.responses.create.call_args[1]["max_output_tokens"] > 0
+
+        # X-Client-Id is caller-chosen, so budgets are keyed on the remote host
+        summary = client.get("/usage").json()["clients"]
+        assert "tester" not in summary
+        assert summary["testclient"]["requests"] == 1
+        assert summary["testclient"]["total_output_tokens"] == 800
+
+    @patch('app.main.TRUST_CLIENT_ID_HEADER', True)
+    @patch('app.optimizer.get_openai')
+    def test_client_id_header_used_when_trusted(self, mock_get_openai):
+        mock_get_openai.return_value.responses.create.return_value = Mock(output_text="Improved prompt.")
+
+        client.post("/optimize", json={"text": "test prompt"}, headers={"X-Client-Id": "tester"})
+        assert client.get("/usage").json()["clients"]["tester"]["requests"] == 1
+
+    @patch('app.optimizer.get_openai')
+    def test_incomplete_o1_response_falls_back(self, mock_get_openai):
+        mock_client = Mock()
+        incomplete = Mock(status="incomplete", output_text="")
+        incomplete.incomplete_details.reason = "max_output_tokens"
+        incomplete.usage = Mock(input_tokens=300, output_tokens=16000)
+        mock_client.responses.create.return_value = incomplete
+        mock_client.chat.completions.create.return_value.choices = [Mock(message=Mock(content="Fallback prompt"))]
+        mock_client.chat.completions.create.return_value.usage = Mock(
+            spec=["prompt_tokens", "completion_tokens"], prompt_tokens=300, completion_tokens=50
+        )
+        mock_get_openai.return_value = mock_client
+
+        response = client.post("/optimize", json={"text": "test prompt"})
+        data = response.json()
+        assert data["improved_prompt"] == "Fallback prompt"
+        # The wasted o1 reasoning spend is still accounted for
+        assert data["usage"]["output_tokens"] == 16050
+        assert data["usage"]["model"] == "gpt-4o-mini"
+
+    @patch('app.main.usage_tracker')
+    @patch('app.main.get_openai')
+    @patch('app.optimizer.get_openai')
+    def test_chat_rejected_before_optimization_spend(self, mock_get_openai, mock_main_get_openai, mock_tracker):
+        mock_tracker.check_calls.side_effect = BudgetExceededError("Client cost budget exhausted")
+        mock_client = Mock()
+        mock_get_openai.return_value = mock_client
+        mock_main_get_openai.return_value = mock_client
+
+        response = client.post("/chat", json={"user_input": "test prompt"})
+        assert response.status_code == 429
+        mock_client.responses.create.assert_not_called()
+
+    @patch('app.optimizer.get_openai')
+    @patch('app.optimizer.choose_optimizer_model')
+    def test_oversized_input_rejected_before_upstream(self, mock_choose, mock_get_openai):
+        mock_choose.side_effect = BudgetExceededError("too large", status_code=413)
+        mock_client = Mock()
+        mock_get_openai.return_value = mock_client
+
+        with patch('app.optimizer.semantic_cache') as mock_cache:
+            response = client.post("/optimize", json={"text": "test prompt"})
+        assert response.status_code == 413
+        # Rejected before the prompt is hashed for a cache lookup
+        mock_cache.lookup.assert_not_called()
+        mock_client.responses.create.assert_not_called()
+        mock_client.chat.completions.create.assert_not_called()
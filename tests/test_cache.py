@@ -0,0 +1,164 @@
+"""
+Tests for the semantic near-duplicate cache
+"""
+
+from unittest.mock import Mock, patch
+from fastapi.testclient import TestClient
+from app.main import app
+from app.cache import SemanticCache, extract_slots, substitute_slots, minhash_signature, signature_similarity
+from app.optimizer import rewrite_prompt_with_usage, OptimizationMode
+
+client = TestClient(app)
+
+
+class TestNormalization:
+    """Test template extraction and slot substitution"""
+
+    def test_whitespace_casing_and_punctuation_ignored(self):
+        assert extract_slots("Explain  recursion!")[0] == extract_slots("explain recursion")[0]
+
+    def test_names_and_numbers_become_slots(self):
+        template_bob, values_bob = extract_slots("Summarize this email from Bob")
+        template_alice, values_alice = extract_slots("summarize this email from Alice.")
+        assert template_bob == template_alice
+        assert values_bob == ["Bob"]
+        assert values_alice == ["Alice"]
+
+        _, values = extract_slots("List 5 tips for Python")
+        assert values == ["5", "Python"]
+
+    def test_substitute_slots(self):
+        text = "Summarize the email from Bob to Alice."
+        assert substitute_slots(text, ["Bob", "Alice"], ["Alice", "Bob"]) == "Summarize the email from Alice to Bob."
+        assert substitute_slots(text, ["Bob"], ["Bob", "Carol"]) is None
+        assert substitute_slots(text, ["Bob", "Bob"], ["Carol", "Dave"]) is None
+        assert substitute_slots("Meet at 3pm", ["3"], ["4"]) == "Meet at 4pm"
+
+    def test_substitute_slots_requires_old_value_in_text(self):
+        text = "Write three well-structured paragraphs about dogs."
+        assert substitute_slots(text, ["3"], ["300"]) is None
+        assert substitute_slots(text, ["3"], ["3"]) == text
+
+
+class TestSemanticCache:
+    """Test near-duplicate lookups"""
+
+    def test_near_duplicate_hit_with_substitution(self):
+        cache = SemanticCache(threshold=0.9)
+        cache.store("Summarize this email from Bob", "standard", "Summarize the email from Bob in three bullet points.")
+
+        hit = cache.lookup("summarize this email from Alice!", "standard")
+        assert hit is not None
+        assert hit.optimized == "Summarize the email from Alice in three bullet points."
+
+    def test_reworded_slot_value_is_a_miss(self):
+        cache = SemanticCache()
+        cache.store("Write 3 paragraphs about dogs", "standard", "Write three well-structured paragraphs about dogs.")
+        assert cache.lookup("Write 300 paragraphs about dogs", "standard") is None
+
+    def test_lowercase_name_matches_same_name(self):
+        cache = SemanticCache()
+        cache.store("Fix this code in Python", "standard", "Fix the following Python code and explain the bug.")
+        hit = cache.lookup("fix this code in python", "standard")
+        assert hit is not None
+        assert hit.optimized == "Fix the following Python code and explain the bug."
+        # A different lowercase word cannot be told apart from an ordinary word
+        assert cache.lookup("fix this code in detail", "standard") is None
+
+    def test_exact_only_entry_skips_near_duplicates(self):
+        draft = "Explain how a hash map handles collisions when two keys land in the same bucket"
+        cache = SemanticCache(threshold=0.9)
+        cache.store(draft, "standard", "Explain hash map collision handling.", exact_only=True)
+        assert cache.lookup("Can you " + draft.lower(), "standard") is None
+        assert cache.lookup(draft.lower() + "!", "standard") is not None
+
+        cache.store(draft, "standard", "Explain hash map collision handling.")
+        assert cache.lookup("Can you " + draft.lower(), "standard") is not None
+
+    def test_modes_are_isolated(self):
+        cache = SemanticCache()
+        cache.store("Explain recursion", "standard", "Explain recursion step by step.")
+        assert cache.lookup("Explain recursion", "concise") is None
+        assert cache.lookup("Explain recursion", "standard") is not None
+
+    def test_unrelated_prompt_misses(self):
+        cache = SemanticCache()
+        cache.store("Explain recursion with an example", "standard", "Explain recursion...")
+        assert cache.lookup("Write a haiku about autumn leaves", "standard") is None
+        stats = cache.stats()
+        assert stats["hits"] == 0
+        assert stats["misses"] == 1
+
+    def test_threshold_is_configurable(self):
+        strict = SemanticCache(threshold=1.0)
+        loose = SemanticCache(threshold=0.5)
+        for cache in (strict, loose):
+            cache.store("Explain recursion and iteration with examples", "standard", "optimized")
+        assert strict.lookup("Explain iteration and recursion with examples", "standard") is None
+        assert loose.lookup("Explain iteration and recursion with examples", "standard") is not None
+
+    def test_one_changed_word_is_a_miss(self):
+        cache = SemanticCache(threshold=0.5)
+        essay = "Write a persuasive essay arguing that remote work is good for productivity and employee wellbeing"
+        cache.store(essay, "standard", "optimized")
+        assert cache.lookup(essay.replace("is good", "is not good"), "standard") is None
+        assert cache.lookup(essay.replace("good", "bad"), "standard") is None
+        assert cache.lookup("Explain how binary search works", "standard") is None
+
+    def test_filler_words_still_hit(self):
+        cache = SemanticCache()
+        prompt = "Write a Python function that sorts a list of customer records by signup date in ascending order"
+        cache.store(prompt, "standard", "optimized")
+        assert cache.lookup("Please write a Python function that sorts the list of customer records by signup date "
+                            "in ascending order", "standard") is not None
+        assert cache.lookup(prompt.replace("ascending", "descending"), "standard") is None
+
+    def test_long_prompt_signature_is_bounded(self):
+        words = " ".join(f"word{i}" for i in range(20000))
+        assert minhash_signature(words) == minhash_signature(words)
+        assert signature_similarity(minhash_signature(words), minhash_signature(words + " extra")) > 0.9
+
+    def test_eviction(self):
+        cache = SemanticCache(max_entries=2)
+        cache.store("Explain recursion", "standard", "a")
+        cache.store("Write a haiku about autumn", "standard", "b")
+        cache.store("Describe the water cycle", "standard", "c")
+        assert cache.stats()["entries"] == 2
+        assert cache.lookup("Explain recursion", "standard") is None
+
+
+class TestCachedOptimization:
+    """Test the cache in front of rewrite_prompt"""
+
+    @patch('app.optimizer.get_openai')
+    def test_second_request_served_from_cache(self, mock_get_openai):
+        mock_client = Mock()
+        mock_response = Mock()
+        mock_response.output_text = "Summarize the email from Bob in three bullet points."
+        mock_client.responses.create.return_value = mock_response
+        mock_get_openai.return_value = mock_client
+
+        first, first_usage = rewrite_prompt_with_usage("Summarize this email from Bob", OptimizationMode.STANDARD)
+        second, second_usage = rewrite_prompt_with_usage("summarize this email from Alice", OptimizationMode.STANDARD)
+
+        mock_client.responses.create.assert_called_once()
+        assert not first_usage.cached
+        assert second_usage.cached
+        assert second_usage.total_tokens == 0
+        assert second == "Summarize the email from Alice in three bullet points."
+
+    @patch('app.optimizer.get_openai')
+    def test_cache_stats_endpoint(self, mock_get_openai):
+        mock_client = Mock()
+        mock_response = Mock()
+        mock_response.output_text = "Explain recursion step by step."
+        mock_client.responses.create.return_value = mock_response
+        mock_get_openai.return_value = mock_client
+
+        client.post("/optimize", json={"text": "explain recursion"})
+        response = client.post("/optimize", json={"text": "Explain recursion!"})
+        assert response.json()["usage"]["cached"] is True
+
+        stats = client.get("/cache/stats").json()
+        assert stats["hits"] == 1
+        assert stats["hit_rate"] == 0.5
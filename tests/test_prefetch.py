@@ -0,0 +1,191 @@
+"""
+Tests for speculative prefetch of optimizations
+"""
+
+import threading
+from unittest.mock import Mock, patch
+from fastapi.testclient import TestClient
+from app.main import app
+from app.budget import BudgetExceededError, UsageTracker
+from app.optimizer import OptimizationMode
+from app.prefetch import PrefetchScheduler, PREFETCH_BUDGET_KEY
+from app.retry import AdaptiveConcurrencyLimiter, is_low_priority
+
+client = TestClient(app)
+
+DRAFT = "Explain how a hash map handles collisions"
+
+
+def make_scheduler(optimize_fn=None, **kwargs):
+    return PrefetchScheduler(optimize_fn=optimize_fn or Mock(), start_worker=False, **kwargs)
+
+
+class TestPrefetchScheduler:
+    """Test job replacement, priority and budget handling"""
+
+    def test_newer_draft_replaces_pending_one(self):
+        optimize = Mock()
+        scheduler = make_scheduler(optimize)
+        first = scheduler.submit("tab-1", DRAFT, OptimizationMode.STANDARD, "c")
+        scheduler.submit("tab-1", DRAFT + " in Python", OptimizationMode.STANDARD, "c")
+
+        assert first.cancelled
+        assert scheduler.run_once()
+        assert not scheduler.run_once()
+        optimize.assert_called_once()
+        assert optimize.call_args[0][0] == DRAFT + " in Python"
+        assert scheduler.summary()["cancelled"] == 1
+
+    def test_short_drafts_ignored(self):
+        scheduler = make_scheduler(min_chars=20)
+        assert scheduler.submit("tab-1", "hi", OptimizationMode.STANDARD, "c") is None
+        assert scheduler.summary()["pending"] == 0
+
+    def test_waits_for_interactive_requests(self):
+        optimize = Mock()
+        scheduler = make_scheduler(optimize)
+        scheduler.submit("tab-1", DRAFT, OptimizationMode.STANDARD, "c")
+
+        with scheduler.interactive():
+            assert not scheduler.run_once()
+        assert scheduler.run_once()
+        optimize.assert_called_once()
+
+    def test_charged_to_prefetch_budget(self):
+        tracker = UsageTracker()
+        optimize = Mock(side_effect=BudgetExceededError("prefetch budget exhausted"))
+        scheduler = make_scheduler(optimize, tracker=tracker)
+        scheduler.submit("tab-1", DRAFT, OptimizationMode.STANDARD, "c")
+
+        assert scheduler.run_once()
+        assert optimize.call_args[1]["tracker"] is tracker
+        assert optimize.call_args[1]["speculative"] is True
+        assert scheduler.summary()["over_budget"] == 1
+
+    def test_budget_shared_across_clients(self):
+        optimize = Mock()
+        scheduler = make_scheduler(optimize)
+        scheduler.submit("tab-1", DRAFT, OptimizationMode.STANDARD, "client-a")
+        scheduler.submit("tab-2", DRAFT + " in Python", OptimizationMode.STANDARD, "client-b")
+        while scheduler.run_once():
+            pass
+        assert {c[0][2] for c in optimize.call_args_list} == {PREFETCH_BUDGET_KEY}
+
+    def test_upstream_calls_are_low_priority(self):
+        seen = []
+        scheduler = make_scheduler(lambda *args, **kwargs: seen.append(is_low_priority()))
+        scheduler.submit("tab-1", DRAFT, OptimizationMode.STANDARD, "c")
+        assert scheduler.run_once()
+        assert seen == [True]
+        assert not is_low_priority()
+
+    def test_wait_for_in_flight_job(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_optimize(*args, **kwargs):
+            started.set()
+            release.wait(5)
+
+        scheduler = make_scheduler(slow_optimize)
+        scheduler.submit("tab-1", DRAFT, OptimizationMode.STANDARD, "c")
+        worker = threading.Thread(target=scheduler.run_once)
+        worker.start()
+        started.wait(5)
+
+        with scheduler._cond:
+            scheduler._running[(OptimizationMode.STANDARD.value, DRAFT)].upstream = True
+        assert not scheduler.wait_for(DRAFT, OptimizationMode.STANDARD, timeout=0.01)
+        release.set()
+        assert scheduler.wait_for(DRAFT, OptimizationMode.STANDARD, timeout=5)
+        worker.join(5)
+        assert not scheduler.wait_for("Another draft entirely", OptimizationMode.STANDARD)
+
+
+    def test_job_queued_for_a_slot_is_cancelled_not_joined(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=8, min_limit=1, queue_timeout=5)
+        limiter.on_rate_limited()
+        started = threading.Event()
+        upstream = Mock()
+
+        def optimize(*args, **kwargs):
+            started.set()
+            with limiter.slot():
+                upstream()
+
+        scheduler = make_scheduler(optimize)
+        scheduler.submit("tab-1", DRAFT, OptimizationMode.STANDARD, "c")
+        worker = threading.Thread(target=scheduler.run_once)
+        worker.start()
+        started.wait(5)
+
+        # The job is held back by the limiter, so the hotkey does not wait for it
+        assert not scheduler.wait_for(DRAFT, OptimizationMode.STANDARD, timeout=5)
+        for _ in range(50):
+            limiter.on_success()
+        worker.join(5)
+        upstream.assert_not_called()
+        assert limiter.in_flight == 0
+        assert scheduler.summary()["cancelled"] == 1
+
+
+class TestPrefetchEndpoints:
+    """Test prefetch through the API"""
+
+    @patch('app.optimizer.get_openai')
+    def test_hotkey_served_from_prefetched_cache(self, mock_get_openai):
+        mock_client = Mock()
+        mock_response = Mock()
+        mock_response.output_text = "Explain, step by step, how a hash map handles collisions."
+        mock_client.responses.create.return_value = mock_response
+        mock_get_openai.return_value = mock_client
+
+        scheduler = PrefetchScheduler(start_worker=False)
+        with patch('app.main.prefetch_scheduler', scheduler):
+            response = client.post("/prefetch", json={"session_id": "tab-1", "text": DRAFT, "mode": "technical"})
+            assert response.json()["accepted"] is True
+            assert scheduler.run_once()
+
+            response = client.post("/optimize", json={"text": DRAFT, "mode": "technical"})
+            assert response.json()["usage"]["cached"] is True
+            assert response.json()["improved_prompt"] == mock_response.output_text
+            mock_client.responses.create.assert_called_once()
+
+            # Only the hotkey lookup counts towards the cache hit rate
+            cache_stats = client.get("/cache/stats").json()
+            assert (cache_stats["hits"], cache_stats["misses"]) == (1, 0)
+
+            stats = client.get("/prefetch/stats").json()
+            assert stats["completed"] == 1
+            assert stats["budget"][PREFETCH_BUDGET_KEY]["requests"] == 1
+
+    @patch('app.optimizer.get_openai')
+    def test_extended_draft_not_served_from_prefetch(self, mock_get_openai):
+        draft = "Explain how a hash map handles collisions when two keys land in the same bucket"
+        mock_client = Mock()
+        mock_client.responses.create.side_effect = [Mock(output_text="Draft optimization"), Mock(output_text="Formal optimization")]
+        mock_get_openai.return_value = mock_client
+
+        scheduler = PrefetchScheduler(start_worker=False)
+        with patch('app.main.prefetch_scheduler', scheduler):
+            client.post("/prefetch", json={"session_id": "tab-1", "text": draft, "mode": "technical"})
+            assert scheduler.run_once()
+
+            response = client.post("/optimize", json={"text": draft + " formally", "mode": "technical"})
+            assert response.json()["usage"]["cached"] is False
+            assert response.json()["improved_prompt"] == "Formal optimization"
+            assert mock_client.responses.create.call_count == 2
+
+    def test_short_draft_rejected(self):
+        scheduler = PrefetchScheduler(start_worker=False)
+        with patch('app.main.prefetch_scheduler', scheduler):
+            response = client.post("/prefetch", json={"session_id": "tab-1", "text": "hi"})
+        assert response.json()["accepted"] is False
+
+    def test_rejected_when_cache_disabled(self):
+        scheduler = PrefetchScheduler(start_worker=False)
+        with patch('app.main.prefetch_scheduler', scheduler), patch('app.main.SEMANTIC_CACHE_ENABLED', False):
+            response = client.post("/prefetch", json={"session_id": "tab-1", "text": DRAFT})
+        assert response.json()["accepted"] is False
+        assert "cache" in response.json()["reason"].lower()
+        assert scheduler.summary()["pending"] == 0
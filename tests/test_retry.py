@@ -0,0 +1,248 @@
+"""
+Tests for the upstream retry policy and adaptive concurrency limiter
+"""
+
+import pytest
+import openai
+from unittest.mock import Mock, patch
+from app.retry import (
+    RetryPolicy, RetryBudget, AdaptiveConcurrencyLimiter, UpstreamBusyError,
+    is_retryable, is_auth_error, retry_after_seconds, low_priority
+)
+from app.optimizer import rewrite_prompt
+
+
+def status_error(cls, status, headers=None):
+    response = Mock(status_code=status, headers=headers or {})
+    return cls(f"HTTP {status}", response=response, body=None)
+
+
+def make_policy(**kwargs):
+    sleeps = []
+    policy = RetryPolicy(base_wait=0.01, sleep=sleeps.append, **kwargs)
+    return policy, sleeps
+
+
+class TestErrorClassification:
+    """Test retryable vs fatal error classification"""
+
+    def test_retryable_errors(self):
+        assert is_retryable(status_error(openai.RateLimitError, 429))
+        assert is_retryable(status_error(openai.InternalServerError, 503))
+        assert is_retryable(openai.APITimeoutError(request=Mock()))
+
+    def test_fatal_errors(self):
+        assert not is_retryable(status_error(openai.BadRequestError, 400))
+        assert not is_retryable(status_error(openai.AuthenticationError, 401))
+        assert not is_retryable(ValueError("bad input"))
+        assert is_auth_error(status_error(openai.AuthenticationError, 401))
+        assert not is_auth_error(status_error(openai.RateLimitError, 429))
+
+    def test_retry_after_headers(self):
+        assert retry_after_seconds(status_error(openai.RateLimitError, 429, {"retry-after": "3"})) == 3.0
+        assert retry_after_seconds(status_error(openai.RateLimitError, 429, {"retry-after-ms": "250"})) == 0.25
+        headers = {
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-reset-requests": "1m30s",
+            "x-ratelimit-remaining-tokens": "100",
+            "x-ratelimit-reset-tokens": "20ms",
+        }
+        assert retry_after_seconds(status_error(openai.RateLimitError, 429, headers)) == 90.0
+        assert retry_after_seconds(ValueError("no response")) is None
+
+
+class TestRetryPolicy:
+    """Test retries, backoff and the retry budget"""
+
+    def test_retries_transient_errors_then_succeeds(self):
+        policy, sleeps = make_policy()
+        fn = Mock(side_effect=[status_error(openai.InternalServerError, 500), "ok"])
+        assert policy.call(fn, 1, key="value") == "ok"
+        assert fn.call_count == 2
+        fn.assert_called_with(1, key="value")
+        assert len(sleeps) == 1
+
+    def test_fatal_error_not_retried(self):
+        policy, sleeps = make_policy()
+        fn = Mock(side_effect=status_error(openai.BadRequestError, 400))
+        with pytest.raises(openai.BadRequestError):
+            policy.call(fn)
+        assert fn.call_count == 1
+        assert sleeps == []
+
+    def test_honors_retry_after(self):
+        policy, sleeps = make_policy(max_wait=10)
+        fn = Mock(side_effect=[status_error(openai.RateLimitError, 429, {"retry-after": "2"}), "ok"])
+        assert policy.call(fn) == "ok"
+        assert sleeps == [2.0]
+
+    def test_retry_after_longer_than_max_wait_not_retried(self):
+        policy, sleeps = make_policy(max_wait=5)
+        fn = Mock(side_effect=status_error(openai.RateLimitError, 429, {"retry-after": "60"}))
+        with pytest.raises(UpstreamBusyError) as exc:
+            policy.call(fn)
+        assert exc.value.retry_after == 60
+        assert fn.call_count == 1
+        assert sleeps == []
+
+    def test_insufficient_quota_is_fatal(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=8, min_limit=1)
+        policy, sleeps = make_policy(limiter=limiter)
+        error = openai.RateLimitError("HTTP 429", response=Mock(status_code=429, headers={}),
+                                      body={"code": "insufficient_quota", "message": "quota exceeded"})
+        fn = Mock(side_effect=error)
+        with pytest.raises(openai.RateLimitError):
+            policy.call(fn)
+        assert fn.call_count == 1
+        assert sleeps == []
+        assert limiter.limit == 8
+
+    def test_stream_holds_slot_until_read(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=2, min_limit=1)
+        policy, _ = make_policy(limiter=limiter)
+        fn = Mock(side_effect=[status_error(openai.InternalServerError, 500), iter(["a", "b"])])
+        with policy.stream(fn, stream=True) as stream:
+            assert limiter.in_flight == 1
+            assert list(stream) == ["a", "b"]
+        assert limiter.in_flight == 0
+        assert fn.call_count == 2
+
+    def test_gives_up_after_max_attempts(self):
+        policy, _ = make_policy(max_attempts=3)
+        fn = Mock(side_effect=status_error(openai.InternalServerError, 502))
+        with pytest.raises(openai.InternalServerError):
+            policy.call(fn)
+        assert fn.call_count == 3
+
+    def test_retry_budget_limits_retries(self):
+        budget = RetryBudget(ratio=0, min_per_second=0, max_tokens=1)
+        policy, _ = make_policy(max_attempts=5, budget=budget)
+        fn = Mock(side_effect=status_error(openai.InternalServerError, 500))
+        with pytest.raises(openai.InternalServerError):
+            policy.call(fn)
+        # One attempt plus the single retry the budget allows
+        assert fn.call_count == 2
+
+
+class TestAdaptiveConcurrency:
+    """Test the AIMD concurrency limiter"""
+
+    def test_rate_limit_halves_and_success_recovers(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=8, min_limit=1)
+        policy, _ = make_policy(limiter=limiter)
+        fn = Mock(side_effect=[status_error(openai.RateLimitError, 429), "ok"])
+        policy.call(fn)
+        assert limiter.limit == 4
+
+        for _ in range(50):
+            limiter.on_success()
+        assert limiter.limit == 8
+
+    def test_burst_of_429s_halves_once(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=8, min_limit=1, cooldown=60)
+        for _ in range(5):
+            limiter.on_rate_limited()
+        assert limiter.limit == 4
+
+    def test_limit_never_below_minimum(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=4, min_limit=2, cooldown=0)
+        for _ in range(10):
+            limiter.on_rate_limited()
+        assert limiter.limit == 2
+
+    def test_low_priority_leaves_reserved_slot(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=2, min_limit=1, queue_timeout=0.01, reserved=1)
+        with limiter.slot(low=True):
+            with pytest.raises(UpstreamBusyError):
+                with limiter.slot(low=True):
+                    pass
+            with limiter.slot():
+                assert limiter.in_flight == 2
+
+    def test_low_priority_waits_while_rate_limited(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=8, min_limit=1, queue_timeout=0.01, reserved=1)
+        limiter.on_rate_limited()
+        with pytest.raises(UpstreamBusyError):
+            with low_priority():
+                with limiter.slot():
+                    pass
+        with limiter.slot():
+            assert limiter.in_flight == 1
+
+    def test_queue_timeout_raises_busy(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=1, min_limit=1, queue_timeout=0.01)
+        with limiter.slot():
+            with pytest.raises(UpstreamBusyError):
+                with limiter.slot():
+                    pass
+        assert limiter.in_flight == 0
+
+
+class TestOptimizerFallback:
+    """Test how the optimizer falls back after upstream errors"""
+
+    @patch('app.optimizer.get_openai')
+    def test_auth_error_skips_fallback(self, mock_get_openai):
+        mock_client = Mock()
+        mock_client.responses.create.side_effect = status_error(openai.AuthenticationError, 401)
+        mock_get_openai.return_value = mock_client
+
+        with pytest.raises(openai.AuthenticationError):
+            rewrite_prompt("explain recursion")
+        mock_client.chat.completions.create.assert_not_called()
+
+    @patch('app.optimizer.call_with_retry')
+    @patch('app.optimizer.get_openai')
+    def test_busy_upstream_skips_fallback(self, mock_get_openai, mock_call):
+        mock_call.side_effect = UpstreamBusyError("too many requests queued")
+
+        with pytest.raises(UpstreamBusyError):
+            rewrite_prompt("explain recursion")
+        assert mock_call.call_count == 1
+
+    @patch('app.optimizer.get_openai')
+    def test_bad_request_falls_back(self, mock_get_openai):
+        mock_client = Mock()
+        mock_client.responses.create.side_effect = status_error(openai.BadRequestError, 400)
+        mock_client.chat.completions.create.return_value.choices = [Mock(message=Mock(content="Fallback prompt"))]
+        mock_get_openai.return_value = mock_client
+
+        assert rewrite_prompt("explain recursion") == "Fallback prompt"
+        mock_client.responses.create.assert_called_once()
+
+
+class TestClientConfiguration:
+    """Test that the SDK does not retry underneath the retry policy"""
+
+    @patch.dict('os.environ', {'OPENAI_API_KEY': 'test-key'})
+    def test_sdk_retries_disabled(self):
+        import app.clients
+        app.clients._client = None
+        assert app.clients.get_openai().max_retries == 0
+
+
+class TestChatStreaming:
+    """Test that streamed answers go through the retry policy"""
+
+    @patch('app.main.get_openai')
+    @patch('app.optimizer.get_openai')
+    def test_stream_opened_under_retry_policy(self, mock_get_openai, mock_main_get_openai):
+        from fastapi.testclient import TestClient
+        from app.main import app
+
+        mock_get_openai.return_value.responses.create.return_value = Mock(output_text="Improved prompt.")
+        events = [
+            Mock(type="response.output_text.delta", delta="Hel"),
+            Mock(type="response.output_text.delta", delta="lo"),
+            Mock(type="response.completed", response=Mock(usage=Mock(input_tokens=5, output_tokens=2))),
+        ]
+        create = mock_main_get_openai.return_value.responses.create
+        create.side_effect = [status_error(openai.InternalServerError, 503), iter(events)]
+        limiter = AdaptiveConcurrencyLimiter(max_limit=2, min_limit=1)
+
+        with patch('app.retry.retry_policy', RetryPolicy(limiter=limiter, sleep=lambda _: None)):
+            response = TestClient(app).post("/chat", json={"user_input": "say hello", "stream": True})
+        assert response.text == "Hello"
+        assert create.call_count == 2
+        assert create.call_args[1]["stream"] is True
+        assert limiter.in_flight == 0